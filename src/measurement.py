@@ -4,57 +4,276 @@ import pandas as pd
 
 import tools
 import simulation.simulator as simulator
+import simulation.trajectories as trajectories
 import measurement_tool
 
 import metrics
+import tools.artifacts
+import tools.summary
 
 import time
 import sumolib
 
+import os
 import argparse
 import json
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("config_file", type=str, help="configuration json file")
-    parser.add_argument("result_path", type=str, help="path where the results will be saved to")
-    parser.add_argument('-n','--mix_n', nargs='+', help='<Required> n values for mix method', required=True,
-                       )#type=lambda s: [int(item) for item in s.split(',')])
+#values of the "origin_inference" configuration key:
+ORIGIN_INFERENCES = ["matrix_power", "vector_propagation"]
+
+
+def load_chain(config, net):
+    '''
+        Builds the Markov chain of a configuration and the precomputed artifacts, or loads them
+        from the artifact cache (if "artifact_cache_dir" is configured).
+        Parameters:
+            config: measurement configuration
+            net: SUMO road network
+        Returns:
+            P, P_b, edge_to_index_map, index_to_edge_map, matrix_power, source_probs, distance_calculator
+            (P and P_b are CSR matrices with "sparse_mc", dense arrays otherwise)
+    '''
+    #"sparse_mc" keeps the chain (P, P_b) sparse from its construction to the simulation; the alter
+    #distributions, the distance matrix and the powers of P_b ("matrix_power" origin inference)
+    #are dense N x N arrays in either case:
+    sparse_mc = config.get("sparse_mc", False)
+    origin_inference = config.get("origin_inference", "matrix_power")
+    if not(origin_inference in ORIGIN_INFERENCES):
+        raise ValueError("unknown origin_inference {!r}, allowed values: {}".format(
+            origin_inference, ", ".join(ORIGIN_INFERENCES)))
+    budget_mb = config.get("matrix_power_budget_mb")
+    memory_budget = None if budget_mb is None else budget_mb*2**20
+    spill_dir = config.get("matrix_power_spill_dir")
+    p_length = config["feeding_model"]["path_length_model"]
+    #without power tensor, the ego probabilities are looked up through matrix_power: with a memory
+    #budget (and no "power_tensor_path"), only the powers within the budget are kept in memory
+    #(the evicted ones are spilled, or recomputed when they are looked up):
+    lazy = (origin_inference == "vector_propagation") or (
+        not(memory_budget is None) and (config.get("power_tensor_path") is None))
+    
+    #precomputed artifacts are shared among the runs of the same network and turning definitions:
+    cache = None
+    if not(config.get("artifact_cache_dir") is None):
+        cache = tools.artifacts.ArtifactCache(config["artifact_cache_dir"], config)
+    
+    #a cache filled by a lazy run has no power tensor, a run using the tensor completes it:
+    if not(cache is None) and cache.is_complete() and (lazy or cache.has_array("power_tensor")):
+        print("Loading precomputed artifacts from {}".format(cache.path))
+        P_, π, P_b, edge_to_index_map, index_to_edge_map, source_probs, distance_calculator = (
+            tools.artifacts.load_chain_artifacts(cache, sparse=sparse_mc))
+        if (origin_inference == "matrix_power") and not(source_probs.power_tensor is None):
+            #the memory-mapped powers are not counted in the memory budget:
+            matrix_power = tools.utils.MatrixPower.from_powers(P_b, source_probs.power_tensor,
+                                                               memory_budget=memory_budget,
+                                                               spill_dir=spill_dir)
+        else:
+            matrix_power = (tools.utils.VectorPropagation(P_b, max_n=len(p_length))
+                            if origin_inference == "vector_propagation" else
+                            tools.utils.MatrixPower(P_b, max_n=len(p_length),
+                                                    memory_budget=memory_budget, spill_dir=spill_dir))
+            source_probs = metrics.SourceProbabilities.from_arrays(None, source_probs.alter_sources, matrix_power)
+        return P_, P_b, edge_to_index_map, index_to_edge_map, matrix_power, source_probs, distance_calculator
     
-    args = parser.parse_args()
-    config = {}
-    with open(args.config_file) as f:
-        config = json.load(f)
-    mix_n = [int(x) for x in args.mix_n]
-    print(mix_n)
-        
     P, edge_to_index_map, index_to_edge_map = tools.mc.read_MC(
         config["sumo_grid"],
         config["specific_turning_definition"],
-        config["default_turning_definition"])
-    net = sumolib.net.readNet(config["sumo_grid"])
+        config["default_turning_definition"],
+        sparse=sparse_mc)
     P_ = P
     π = tools.mc.calculate_stationary_distribution(P_)
     P_b = tools.mc.calculate_time_reversed_mc(P_, π)
-    matrix_power = tools.utils.MatrixPower(P_b)
-    measurement_tool = measurement_tool.MeasCallback(net, P_, P_b, edge_to_index_map, index_to_edge_map,
+    if lazy:
+        #the ego distributions are looked up through matrix_power (vector propagation does not
+        #store the powers of P_b):
+        matrix_power = (tools.utils.VectorPropagation(P_b, max_n=len(p_length))
+                        if origin_inference == "vector_propagation" else
+                        tools.utils.MatrixPower(P_b, max_n=len(p_length),
+                                                memory_budget=memory_budget, spill_dir=spill_dir))
+        source_probs = metrics.SourceProbabilities(matrix_power, P_b, p_length)
+    else:
+        #the powers are computed once into the power tensor, MatrixPower serves them from it:
+        source_probs = metrics.SourceProbabilities(None, P_b, p_length, config.get("power_tensor_path"))
+        matrix_power = tools.utils.MatrixPower.from_powers(P_b, source_probs.power_tensor,
+                                                           memory_budget=memory_budget, spill_dir=spill_dir)
+    edge_lengths = [net.getEdge(index_to_edge_map[i]).getLength() for i in range(len(index_to_edge_map))]
+    distance_calculator = metrics.DistanceCalculator(P_, edge_lengths)
+    if not(cache is None):
+        tools.artifacts.save_chain_artifacts(cache, P_, π, P_b, index_to_edge_map,
+                                             source_probs, distance_calculator)
+    return P_, P_b, edge_to_index_map, index_to_edge_map, matrix_power, source_probs, distance_calculator
+
+
+def prepare_artifacts(config):
+    ''' Fills the artifact cache of a configuration (if it is not filled yet).'''
+    cache = tools.artifacts.ArtifactCache(config["artifact_cache_dir"], config)
+    if not(cache.is_complete()):
+        load_chain(config, sumolib.net.readNet(config["sumo_grid"]))
+    return cache.path
+
+
+#components with their own random streams:
+RANDOM_COMPONENTS = ["new_vehicles", "movements", "tell"]
+
+
+def random_seeds(seed):
+    '''
+        Spawns an independent np.random.SeedSequence for every random component of a run.
+        Parameters:
+            seed: an integer or a np.random.SeedSequence (e.g. spawned for a replication)
+        Returns:
+            a component name (see RANDOM_COMPONENTS) -> np.random.SeedSequence map
+    '''
+    seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    #the children are derived from the spawn key (like SeedSequence.spawn, without changing seed):
+    return {component: np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key+(i,))
+            for i, component in enumerate(RANDOM_COMPONENTS)}
+
+
+def random_streams(seed):
+    ''' Returns a component name -> np.random.Generator map of the random_seeds.'''
+    return {component: np.random.default_rng(child) for component, child in random_seeds(seed).items()}
+
+
+def _seed_metadata(seed):
+    #json serializable form of a seed:
+    if isinstance(seed, np.random.SeedSequence):
+        return {"entropy": seed.entropy, "spawn_key": list(seed.spawn_key)}
+    return seed
+
+
+def _seed_from_metadata(seed):
+    #inverse of _seed_metadata:
+    if isinstance(seed, dict):
+        return np.random.SeedSequence(seed["entropy"], spawn_key=tuple(seed["spawn_key"]))
+    return seed
+
+
+def run_measurement(config, result_path, mix_n, config_file=None, seed=None):
+    '''
+        Simulates a configuration and saves its results.
+        Parameters:
+            config: measurement configuration
+            result_path: result directory (with a trailing separator),
+                or a list of them (one per mix_n set)
+            mix_n: n values for the MIX method, or a list of n value sets: these policies are
+                evaluated on the same simulation, and saved into their own result directories
+            config_file: name of the configuration file (stored in the metadata of the results)
+            seed: an integer or a np.random.SeedSequence of the random streams (None: the "seed"
+                of the configuration, or of the replayed trajectory; without it, the global np.random
+                state and unseeded generators)
+    '''
+    seed = config.get("seed") if seed is None else seed
+    if (seed is None) and not(config.get("replay_trajectory") is None):
+        #a replay repeats the tell decisions of the recorded run only with the same seed:
+        recorded = trajectories.Trajectory(config["replay_trajectory"]).metadata or {}
+        seed = _seed_from_metadata(recorded.get("seed"))
+        if seed is None:
+            print("The replayed trajectory was recorded without seed, the tell decisions are not reproduced")
+    seeds = {} if seed is None else random_seeds(seed)
+    streams = {component: np.random.default_rng(child) for component, child in seeds.items()}
+    policies = mix_n if isinstance(mix_n[0], list) else [mix_n]
+    result_paths = result_path if isinstance(result_path, list) else [result_path]
+    assert len(policies) == len(result_paths)
+    net = sumolib.net.readNet(config["sumo_grid"])
+    P_, P_b, edge_to_index_map, index_to_edge_map, matrix_power, source_probs, distance_calculator = (
+        load_chain(config, net))
+    
+    result_format = config.get("result_format", "csv")
+    #online summary statistics, the raw distance records can be omitted:
+    summaries = [tools.summary.RunSummary(measurement_tool.METHOD_NAMES,
+                                          config.get("summary_bins", tools.summary.DEFAULT_BINS),
+                                          config.get("summary_iong_bins"),
+                                          config.get("summary_accuracy", 0.01))
+                 if config.get("summary_statistics", False) else None
+                 for _ in policies]
+    store_records = config.get("store_distance_records", True)
+    stream_paths = [(path+"distances.csv" if result_format == "csv" else path)
+                    if config.get("stream_distances", True) and store_records else None
+                    for path in result_paths]
+    callback = measurement_tool.MeasCallback(net, P_, P_b, edge_to_index_map, index_to_edge_map,
                                 config["feeding_model"]["origin_model"],
                                 matrix_power,
                                 config["feeding_model"]["path_length_model"],
-                                mix_n)
-    sim = simulator.Simulator(P_,
-                              config["feeding_model"]["feed"],
-                              config["feeding_model"]["origin_model"], 
-                              config["feeding_model"]["path_length_model"])
-
+                                policies[0],
+                                config.get("power_tensor_path"),
+                                source_probs,
+                                distance_calculator,
+                                config.get("meeting_radius"),
+                                config.get("meeting_hops", 0),
+                                config.get("correctness_cache_size", 2**16),
+                                config.get("deferred_evaluation", False),
+                                #the tell decisions of every policy are derived from it:
+                                seeds.get("tell"),
+                                #distance records are written during the simulation:
+                                stream_paths,
+                                config.get("distance_chunk_size", 2**18),
+                                result_format,
+                                summaries,
+                                store_records,
+                                policies,
+                                #without distance records, the left vehicles are not kept either:
+                                config.get("evict_finished_vehicles",
+                                           not(store_records) and config.get("summary_statistics", False)
+                                           and not(config.get("deferred_evaluation", False))))
     start_time = time.time()
-    run_steps = sim.simulate(callback_function=measurement_tool)
+    if config.get("replay_trajectory") is None:
+        sim = simulator.Simulator(P_,
+                                  config["feeding_model"]["feed"],
+                                  config["feeding_model"]["origin_model"], 
+                                  config["feeding_model"]["path_length_model"],
+                                  rng=streams.get("movements"),
+                                  new_vehicle_rng=streams.get("new_vehicles"))
+        #the trajectory can be recorded and replayed by later measurements:
+        recorder = (trajectories.TrajectoryRecorder(config["record_trajectory"], callback,
+                                                    metadata={"seed": _seed_metadata(seed)})
+                    if not(config.get("record_trajectory") is None) else None)
+        run_steps = sim.simulate(callback_function=callback if recorder is None else recorder)
+        if not(recorder is None):
+            recorder.close()
+    else:
+        run_steps = trajectories.replay(config["replay_trajectory"], callback)
     stop_time = time.time()
 
     print("Simulator finished in {} steps, computed in {} seconds".format(run_steps, stop_time-start_time))
+    if isinstance(matrix_power, tools.utils.MatrixPower):
+        print("MatrixPower cache: {}".format(matrix_power.cache_info()))
+    print("Correctness cache hit rates: {}".format(callback.correctness_cache.hit_rates()))
     
-    tools.utils.save_results(measurement_tool, args.result_path)
-    
+    tools.utils.save_results(callback, result_paths, result_format,
+                             [{"config_file": config_file, "config": config, "mix_n": policy,
+                               "seed": _seed_metadata(seed)}
+                              for policy in policies])
+    if isinstance(matrix_power, tools.utils.MatrixPower):
+        matrix_power.close()
+    return run_steps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_file", type=str, help="configuration json file")
+    parser.add_argument("result_path", type=str, help="path where the results will be saved to")
+    parser.add_argument('-n','--mix_n', nargs='+', help='n values for mix method (required without --policies)',
+                       )#type=lambda s: [int(item) for item in s.split(',')])
+    parser.add_argument('-p','--policies', nargs='+',
+                        help='mix_n sets evaluated on the same simulation, the digits of an item are the n values;'
+                             ' the results are saved into <result_path>/mix<item>/')
+    parser.add_argument('-s','--seed', type=int, default=None,
+                        help='seed of the random streams (default: the "seed" of the configuration)')
     
-    
\ No newline at end of file
+    args = parser.parse_args()
+    config = {}
+    with open(args.config_file) as f:
+        config = json.load(f)
+    if args.policies is None:
+        assert not(args.mix_n is None), "-n/--mix_n or -p/--policies is required"
+        mix_n = [int(x) for x in args.mix_n]
+        print(mix_n)
+        run_measurement(config, args.result_path, mix_n, args.config_file, args.seed)
+    else:
+        policies = [[int(n) for n in item] for item in args.policies]
+        result_paths = [os.path.join(args.result_path, "mix"+item) + os.sep for item in args.policies]
+        for path in result_paths:
+            os.makedirs(path, exist_ok=True)
+        print(policies)
+        run_measurement(config, result_paths, policies, args.config_file, args.seed)
@@ -5,26 +5,338 @@ import meeting_model
 import movement_tracker
 import tell_decisions
 import metrics
+import tools.results
 
+import os
 import time
+import array
+import queue
+import threading
+import collections
+
+import numpy as np
+import pandas as pd
+
+METHOD_NAMES = ["uniform", "minprob", "last1", "last2", "last3", "mix"]
 
 class DistanceRecords:
-    '''Stores distance measurements.'''
+    '''Columnar store of the distance measurements. Rows are collected into typed chunks
+    (the method is stored as its index in METHOD_NAMES). If a path is given, full chunks
+    are written there by a background thread, so the memory usage is bounded.'''
+    COLUMNS = [("ids", np.int64), ("times", np.int64), ("methods", np.int8),
+               ("distances", np.float32), ("distance_diffs", np.float32)]
+    
+    def __init__(self, path=None, chunk_size=2**18, result_format="csv"):
+        ''' Parameters:
+            path: csv file ("csv" format) or run directory ("binary" format, see tools.results)
+                the records are streamed to (None: records are kept in memory)
+            chunk_size: number of rows per chunk
+            result_format: "csv" or "binary"'''
+        assert result_format in ["csv", "binary"]
+        self.path = path
+        self.result_format = result_format
+        self.chunk_size = chunk_size
+        self.chunks = [] #full chunks kept in memory (if not streamed)
+        self.n_rows = 0 #number of all rows
+        self.n_written_chunks = 0
+        self._new_chunk()
+        self._error = None
+        self._closed = False
+        if not(path is None):
+            if result_format == "csv":
+                self._file = open(path, "w")
+                self._file.write("id,time,method,Alter correctness,Distance difference\n")
+            self._queue = queue.Queue(maxsize=2)
+            self._writer = threading.Thread(target=self._write_loop, daemon=True)
+            self._writer.start()
+    
+    def _new_chunk(self):
+        self.chunk = {name: np.empty(self.chunk_size, dtype=dtype) for name, dtype in self.COLUMNS}
+        self.chunk_rows = 0
+    
+    def extend(self, ids, times, methods, distances, distance_diffs):
+        ''' Appends rows, given column-wise (methods as indices of METHOD_NAMES).'''
+        columns = dict(zip([name for name, _ in self.COLUMNS], [ids, times, methods, distances, distance_diffs]))
+        done = 0
+        while done < len(ids):
+            size = min(len(ids)-done, self.chunk_size-self.chunk_rows)
+            for name, values in columns.items():
+                self.chunk[name][self.chunk_rows:self.chunk_rows+size] = values[done:done+size]
+            self.chunk_rows += size
+            self.n_rows += size
+            done += size
+            if self.chunk_rows == self.chunk_size:
+                self._push()
+    
+    def _push(self):
+        chunk = {name: values[:self.chunk_rows] for name, values in self.chunk.items()}
+        if self.path is None:
+            self.chunks.append(chunk)
+        else:
+            if not(self._error is None):
+                raise self._error
+            self._queue.put(chunk)
+        self._new_chunk()
+    
+    def _write_loop(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                return
+            try:
+                self._write(chunk)
+            except Exception as e:
+                self._error = e
+    
+    def _write(self, chunk):
+        if self.result_format == "csv":
+            self.write_csv(self._file, chunk)
+        else:
+            tools.results.save_distance_chunk(self.path, self.n_written_chunks, chunk, METHOD_NAMES)
+        self.n_written_chunks += 1
+    
+    @staticmethod
+    def write_csv(f, chunk):
+        ''' Writes a chunk as csv rows (distances are rounded to integer meters).'''
+        pd.DataFrame({"id": chunk["ids"], "time": chunk["times"],
+                      "method": np.array(METHOD_NAMES)[chunk["methods"]],
+                      "distance": np.rint(chunk["distances"]).astype(np.int64),
+                      "difference": np.rint(chunk["distance_diffs"]).astype(np.int64)}
+                    ).to_csv(f, header=False, index=False)
+    
+    def columns(self):
+        ''' Returns the in-memory records as a column name -> array map.'''
+        assert self.path is None, "the records are streamed to %s"%self.path
+        chunks = self.chunks + [{name: values[:self.chunk_rows] for name, values in self.chunk.items()}]
+        return {name: np.concatenate([chunk[name] for chunk in chunks]) for name, _ in self.COLUMNS}
+    
+    def close(self):
+        ''' Flushes the remaining rows and waits for the background writer (if streaming).'''
+        if self.path is None or self._closed:
+            return
+        self._closed = True
+        self._push()
+        self._queue.put(None)
+        self._writer.join()
+        if self.result_format == "csv":
+            self._file.close()
+        if not(self._error is None):
+            raise self._error
+    
+    def _check_streamed(self, path, result_format):
+        assert (self.result_format == result_format) and (os.path.abspath(path) == os.path.abspath(self.path)), \
+            "the records have been streamed to %s (%s)"%(self.path, self.result_format)
+    
+    def save_csv(self, filename):
+        ''' Writes all records into a csv file.'''
+        if not(self.path is None):
+            self.close()
+            self._check_streamed(filename, "csv")
+            return
+        with open(filename, "w") as f:
+            f.write("id,time,method,Alter correctness,Distance difference\n")
+            self.write_csv(f, self.columns())
+    
+    def save_binary(self, path):
+        ''' Writes all records into a run directory (see tools.results).
+            Returns the number of the written chunks.'''
+        if not(self.path is None):
+            self.close()
+            self._check_streamed(path, "binary")
+            return self.n_written_chunks
+        chunks = self.chunks + [{name: values[:self.chunk_rows] for name, values in self.chunk.items()}]
+        for index, chunk in enumerate(chunks):
+            tools.results.save_distance_chunk(path, index, chunk, METHOD_NAMES)
+        return len(chunks)
+    
+    def __len__(self):
+        return self.n_rows
+
+
+def _int64_array(values):
+    return array.array("q", np.ascontiguousarray(values, dtype=np.int64).tobytes())
+
+
+class SharingEvents:
+    '''Compact log of the sharing events. The shared segments are stored as references
+    into the movement tracker: route of sender[start:end].'''
     def __init__(self):
+        self.times = array.array("q")
+        self.receivers = array.array("q")
+        self.senders = array.array("q")
+        self.methods = array.array("q") #indices of the telling methods (see MeasCallback.method_names)
+        self.starts = array.array("q")
+        self.ends = array.array("q")
+
+    def extend(self, t, receivers, senders, methods, starts, ends):
+        self.times.extend(_int64_array(np.full(len(receivers), t)))
+        self.receivers.extend(_int64_array(receivers))
+        self.senders.extend(_int64_array(senders))
+        self.methods.extend(_int64_array(methods))
+        self.starts.extend(_int64_array(starts))
+        self.ends.extend(_int64_array(ends))
+
+    def column(self, name, chunk=slice(None)):
+        ''' Returns a (chunk of a) column as an int64 array (without copying).'''
+        return np.frombuffer(getattr(self, name), dtype=np.int64)[chunk]
+
+    def __len__(self):
+        return len(self.times)
+
+
+class CorrectnessCache:
+    '''Bounded LRU cache of the correctness results, keyed by
+    (first shared edge, last shared edge, true origin, n).'''
+    def __init__(self, max_size=2**16):
+        ''' Parameters:
+            max_size: maximal number of stored results'''
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+
+    def get(self, key, method):
+        ''' Returns the stored result of key (None if it is not stored), counting the hits of method.'''
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits[method] += 1
+            return self.entries[key]
+        self.misses[method] += 1
+        return None
+
+    def put(self, key, result):
+        self.entries[key] = result
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def hit_rates(self):
+        ''' Returns the ratio of cache hits per method.'''
+        return {method: self.hits[method]/(self.hits[method]+self.misses[method])
+                for method in set(self.hits) | set(self.misses)}
+
+
+#number of set bits of every byte value:
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def _popcount(words):
+    ''' Returns the number of set bits of uint64 words, summed along the last axis.'''
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    return _POPCOUNT_TABLE[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+class ReceivedInformation:
+    '''Per-vehicle edge bitsets of the visited edges and of the received edges
+    (per telling method). Vehicle ids minus base_id are used as slot indices
+    (see MovementTracker.evict).'''
+    def __init__(self, n_edges, method_names=METHOD_NAMES, capacity=1024):
         ''' Parameters:
-            method_names: names of the records'''
-        self.ids = []
-        self.method = []
-        self.distances = []
-        self.distance_diffs = []
-        self.times = []
+            n_edges: number of edges of the Markov chain
+            method_names: names of the telling methods
+            capacity: initial number of vehicle slots (it is doubled if needed)'''
+        self.method_names = list(method_names)
+        n_words = (n_edges+63)//64
+        self.visited = np.zeros((capacity, n_words), dtype=np.uint64)
+        self.received = np.zeros((len(self.method_names), capacity, n_words), dtype=np.uint64)
+        self.has_received = np.zeros(capacity, dtype=bool)
+        self.base_id = 0
+
+    def _reserve(self, max_id):
+        capacity = len(self.has_received)
+        if max_id < capacity:
+            return
+        capacity = max(2*capacity, max_id+1)
+        visited = np.zeros((capacity, self.visited.shape[1]), dtype=np.uint64)
+        visited[:len(self.visited)] = self.visited
+        received = np.zeros((len(self.method_names), capacity, self.visited.shape[1]), dtype=np.uint64)
+        received[:, :self.received.shape[1]] = self.received
+        has_received = np.zeros(capacity, dtype=bool)
+        has_received[:len(self.has_received)] = self.has_received
+        self.visited, self.received, self.has_received = visited, received, has_received
+
+    @staticmethod
+    def _set_bits(bits, ids, edges):
+        edges = np.asarray(edges, dtype=np.int64)
+        np.bitwise_or.at(bits, (ids, edges >> 6), np.left_shift(np.uint64(1), (edges & 63).astype(np.uint64)))
+
+    def visit(self, ids, edges):
+        ''' Marks edges[i] visited by vehicle ids[i].'''
+        ids = np.asarray(ids, dtype=np.int64) - self.base_id
+        if len(ids) == 0:
+            return
+        self._reserve(ids.max())
+        self._set_bits(self.visited, ids, edges)
+
+    def receive(self, method, receivers, edges, lengths):
+        '''
+            Stores received segments.
+            Parameters:
+                method: name of the telling method
+                receivers: ids of the receiver vehicles
+                edges: the received segments concatenated
+                lengths: lengths of the segments (one per receiver)
+        '''
+        receivers = np.asarray(receivers, dtype=np.int64) - self.base_id
+        if len(receivers) == 0:
+            return
+        self._reserve(receivers.max())
+        self.has_received[receivers] = True
+        self._set_bits(self.received[self.method_names.index(method)], np.repeat(receivers, lengths), edges)
+
+    def iong(self, ids):
+        '''
+            Computes the Information-Otherwise-Not-Gained metric: the number of edges that are
+            received but not visited.
+            Parameters:
+                ids: vehicle ids
+            Returns:
+                a (methods, len(ids)) array, -1 for vehicles that did not receive information
+                (or were evicted)
+        '''
+        ids = np.asarray(ids, dtype=np.int64) - self.base_id
+        answer = np.full((len(self.method_names), len(ids)), -1, dtype=np.int64)
+        known = (ids >= 0) & (ids < len(self.has_received))
+        known[known] = self.has_received[ids[known]]
+        gained = self.received[:, ids[known]] & ~self.visited[ids[known]]
+        answer[:, known] = _popcount(gained)
+        return answer
+
+    def evict(self, first_id):
+        ''' Releases the slots of the vehicles with smaller ids than first_id (like MovementTracker.evict).'''
+        released = min(first_id - self.base_id, len(self.has_received))
+        if released <= 0:
+            return
+        self.has_received[:released] = False
+        if 2*released < len(self.has_received):
+            return
+        for name, axis in [("visited", 0), ("received", 1), ("has_received", 0)]:
+            buffer = np.moveaxis(getattr(self, name), axis, 0)
+            kept = buffer[released:].copy()
+            buffer[:len(kept)] = kept
+            buffer[len(kept):] = 0
+        self.base_id += released
 
 
 class MeasCallback:
     def __init__(self, net, P_f, P_b, edge_to_index_map, index_to_edge_map,
                  o_dist, matrix_power,
                  p_length,
-                 mix_n = [1,2,3]):
+                 mix_n = [1,2,3],
+                 power_tensor_path = None,
+                 source_probs = None,
+                 distance_calculator = None,
+                 meeting_radius = None,
+                 meeting_hops = 0,
+                 correctness_cache_size = 2**16,
+                 deferred_evaluation = False,
+                 tell_seed = None,
+                 distance_records_path = None,
+                 distance_chunk_size = 2**18,
+                 result_format = "csv",
+                 summary = None,
+                 store_records = True,
+                 policies = None,
+                 evict_finished = False):
         '''
             Parameters:
                 net: SUMO road network
@@ -36,134 +348,290 @@ class MeasCallback:
                 matrix_power: matrix poewring object
                 p_length: route length model
                 mix_n: n values for the MIX data selection method
+                power_tensor_path: memory-mapped file of the source probabilities (None: the ego
+                    probabilities are looked up through matrix_power)
+                source_probs: precomputed SourceProbabilities object (None: calculated here)
+                distance_calculator: precomputed DistanceCalculator object (None: calculated here)
+                meeting_radius: if given, vehicles closer than this radius [m] meet
+                meeting_hops: vehicles meet up to this many edges away from the shared junction
+                correctness_cache_size: number of stored correctness results
+                deferred_evaluation: if True, sharing events are only logged during the simulation,
+                    and their correctness is computed by evaluate_deferred_events()
+                tell_seed: np.random.SeedSequence (or integer seed) of the tell decisions (None: seeded
+                    from the global np.random state, so np.random.seed makes the decisions reproducible)
+                distance_records_path: csv file the distance records are streamed to during the
+                    simulation (None: they are kept in memory until save_results),
+                    a list of them if there are more policies
+                distance_chunk_size: number of distance records per chunk
+                result_format: format of the streamed distance records ("csv" or "binary")
+                summary: a tools.summary.RunSummary object updated online (None: no summary),
+                    a list of them if there are more policies
+                store_records: if False, the raw distance records are not stored (only summarized)
+                policies: list of mix_n sets evaluated on the same simulation (None: [mix_n]);
+                    only the MIX decisions differ among them, every policy gets its own outputs
+                evict_finished: if True, the vehicles that left the simulation are released from the
+                    movement tracker and the received information once their IONG is summarized, only
+                    their IONG values are kept (needs a summary, not with deferred evaluation)
         '''
         self.net = net
-        self.meeting_model = meeting_model.Meeting(edge_to_index_map, index_to_edge_map)
+        self.meeting_model = meeting_model.Meeting(edge_to_index_map, index_to_edge_map, net,
+                                                   meeting_radius, meeting_hops)
         self.P = P_b
         self.o_dist = o_dist
         self.matrix_power = matrix_power
         self.index_to_edge_map = index_to_edge_map
         self.p_length = p_length
-        self.mix_n = mix_n
+        self.policies = [list(mix_n)] if policies is None else [list(policy) for policy in policies]
+        self.mix_n = self.policies[0]
+        #the telling methods: the common ones, then the MIX method of every policy:
+        self.method_names = METHOD_NAMES[:-1] + (["mix"] if len(self.policies) == 1 else
+                                                 ["mix"+"".join(str(n) for n in policy) for policy in self.policies])
+        #indices of the methods of a policy (in order of METHOD_NAMES), and the inverse maps:
+        self.policy_methods = [np.array(list(range(len(METHOD_NAMES)-1)) + [len(METHOD_NAMES)-1+p])
+                               for p in range(len(self.policies))]
+        self._output_methods = []
+        for methods in self.policy_methods:
+            output = np.full(len(self.method_names), -1)
+            output[methods] = np.arange(len(METHOD_NAMES))
+            self._output_methods.append(output)
+        tell_seed = np.random.randint(2**31) if tell_seed is None else tell_seed
+        tell_seed = tell_seed if isinstance(tell_seed, np.random.SeedSequence) else np.random.SeedSequence(tell_seed)
+        #the MIX decisions of every policy have their own stream, derived from the n values of the policy
+        #(not from its position), so the results of a policy do not depend on the other evaluated policies:
+        self.rng = np.random.default_rng(tell_seed)
+        self.mix_rngs = [np.random.default_rng(np.random.SeedSequence(tell_seed.entropy,
+                                                                      spawn_key=tell_seed.spawn_key+tuple(policy)))
+                         for policy in self.policies]
+        self.predecessors = tell_decisions.most_likely_predecessors(P_b)
         
-        self.movement_tracker = movement_tracker.MovementTracker()
-        
-        self.received_information_uniform = {}
-        self.received_information_minprob = {}
-        self.received_information_last1 = {}
-        self.received_information_last2 = {}
-        self.received_information_last3 = {}
-        self.received_information_mix = {}
+        self.received_information = ReceivedInformation(len(index_to_edge_map), self.method_names)
         
         self.times = {"dist_calc": 0, "tell_calc": 0, "meetings": 0, "source_p": 0, "distances": 0}
         
-        self.distance_calculator = metrics.DistanceCalculator(P_f)
-        self.source_probs = metrics.SourceProbabilities(matrix_power, P_b, p_length)
-        self.distance_records = DistanceRecords()
+        if distance_calculator is None:
+            edge_lengths = [net.getEdge(index_to_edge_map[i]).getLength() for i in range(len(index_to_edge_map))]
+            distance_calculator = metrics.DistanceCalculator(P_f, edge_lengths)
+        self.distance_calculator = distance_calculator
+        #without power tensor file, the ego lookups are served by matrix_power:
+        self.source_probs = (metrics.SourceProbabilities(matrix_power if power_tensor_path is None else None,
+                                                         P_b, p_length, power_tensor_path)
+                             if source_probs is None else source_probs)
+        self.origin_guesses = metrics.OriginGuessIndex(self.source_probs, n=10)
+        self.movement_tracker = movement_tracker.MovementTracker(self.predecessors, o_dist, self.source_probs,
+                                                                 max_len=len(p_length)+1,
+                                                                 turn_memory=max(3, max(max(policy) for policy in self.policies)+1))
+        self.correctness_cache = CorrectnessCache(correctness_cache_size)
+        self.deferred_evaluation = deferred_evaluation
+        self.sharing_events = SharingEvents()
+        self.deferred_n = 10
+        #outputs per policy:
+        paths = distance_records_path if isinstance(distance_records_path, list) else [distance_records_path]
+        self.distance_records = [DistanceRecords(path, distance_chunk_size, result_format) for path in paths]
+        self.summaries = summary if isinstance(summary, list) else [summary]*len(self.policies)
+        assert len(self.distance_records) == len(self.summaries) == len(self.policies)
+        self.store_records = store_records
+        self._active_ids = np.array([], dtype=np.int64)
+        self.evict_finished = evict_finished
+        assert not(evict_finished) or (any(not(summary is None) for summary in self.summaries)
+                                       and not(deferred_evaluation)), \
+            "evicting finished vehicles needs a summary and no deferred evaluation"
+        #ids and IONG values (per method) of the evicted vehicles:
+        self._finished_ids = []
+        self._finished_iongs = []
         
         
-    def _store_distances(self, t, sender_id, sent_routes, method_names, true_starting_edge, n=10):
+    def _store_distances(self, t, receivers, senders, methods, starts, ends, n=10):
         '''
             Stores the correctness (i.e. reconstruction distances) of alter. This can be
             seen as the privacy loss of ego.
             Parameters:
                 t: timestep
-                sender_id: id of the sender vehicle (ego)
-                sent_route: list of lists of the sent edges per measurement cases
-                   (in order of time, i.e. sent_route[0] is the firstly edge
-                   visited, sent_route[-1] is the point of sharing)
-                method_names: name of the sent_route selection methods
-                true_starting_edge: origin of the sender vehicle (ego)
+                receivers: ids of the receiver vehicles (alter), the records are stored under these ids
+                senders: ids of the sender vehicles (ego)
+                methods: indices of the telling methods (in method_names)
+                starts, ends: the shared segments, route of senders[k] [starts[k]:ends[k]]
                 n: number of most probable edges
             Stores:
-                distances[id][t][x] refers to the top n distances of the given vehicle id
-                shared at timestep t. x iterates through the telling methods
+                n distance records per sharing event, in order of the events
         '''
         time_start = time.time()
-        for route, name in zip(sent_routes, method_names):
-            dist_, dist_dif, times = metrics.calculate_correctness_best_n(self.net, self.index_to_edge_map,
-                                                             self.matrix_power,
-                                                             self.P, route, self.p_length,
-                                                             true_starting_edge,
-                                                             self.source_probs,
-                                                             n=n,
-                                                             distance_calculator = self.distance_calculator)
-            
-            self.times["source_p"] = self.times["source_p"] + times["source_p"]
-            self.times["distances"] = self.times["distances"] + times["distances"]
-            for i in range(n):
-                self.distance_records.ids.append(sender_id)
-                self.distance_records.times.append(t)
-                self.distance_records.method.append(name)
-                self.distance_records.distances.append(dist_[i])
-                self.distance_records.distance_diffs.append(dist_dif[i])
-            
+        if self.deferred_evaluation:
+            assert n == self.deferred_n
+            self.sharing_events.extend(t, receivers, senders, methods, starts, ends)
+            self.times["dist_calc"] = self.times["dist_calc"] + (time.time()-time_start)
+            return
+        first_edges = self.movement_tracker.edges_at(senders, starts)
+        last_edges = self.movement_tracker.edges_at(senders, ends-1)
+        #the origin of the receiver is used as the true origin:
+        origins = self.movement_tracker.edges_at(receivers, np.zeros(len(receivers), dtype=np.int64))
+        distances = np.zeros((len(receivers), n))
+        dist_differences = np.zeros((len(receivers), n))
+        #events that are not cached, and the events sharing their keys (within this call):
+        missing = {}
+        for k, key in enumerate(zip(first_edges.tolist(), last_edges.tolist(), origins.tolist())):
+            #the result depends only on the endpoints of the shared route:
+            key = key+(n,)
+            name = self.method_names[methods[k]]
+            if key in missing:
+                self.correctness_cache.hits[name] += 1
+                missing[key].append(k)
+                continue
+            cached = self.correctness_cache.get(key, name)
+            if cached is None:
+                missing[key] = [k]
+            else:
+                distances[k], dist_differences[k] = cached
+        if len(missing) > 0:
+            t_start = time.time()
+            firsts = [events[0] for events in missing.values()]
+            computed = metrics.calculate_correctness_batch(self.origin_guesses, self.distance_calculator,
+                                                           first_edges[firsts], last_edges[firsts],
+                                                           origins[firsts], n)
+            self.times["distances"] = self.times["distances"] + (time.time()-t_start)
+            for i, (key, events) in enumerate(missing.items()):
+                result = (computed[0][i], computed[1][i])
+                self.correctness_cache.put(key, result)
+                distances[events], dist_differences[events] = result
+        self._append_records(t, receivers, methods, distances, dist_differences)
         self.times["dist_calc"] = self.times["dist_calc"] + (time.time()-time_start)
+
+    def _append_records(self, times, receivers, methods, distances, dist_differences):
+        n = distances.shape[1]
+        times = np.broadcast_to(times, (len(receivers),))
+        #unreachable edge pairs have infinite distances, neither the outputs nor the summaries can take them:
+        invalid = ~(np.isfinite(distances) & np.isfinite(dist_differences)).all(axis=1)
+        if np.any(invalid):
+            raise ValueError("%d sharing events with non-finite distances (unreachable edge pairs), first at timestep %d"%(
+                np.count_nonzero(invalid), times[invalid][0]))
+        for records, summary, output_methods in zip(self.distance_records, self.summaries, self._output_methods):
+            #the records of the methods of the policy, with the method indices of METHOD_NAMES:
+            outputs = output_methods[methods]
+            selected = outputs >= 0
+            if not(summary is None):
+                summary.add_distances(np.repeat(outputs[selected], n), distances[selected].ravel(),
+                                      dist_differences[selected].ravel())
+            if self.store_records:
+                records.extend(np.repeat(receivers[selected], n), np.repeat(times[selected], n),
+                               np.repeat(outputs[selected], n),
+                               distances[selected].ravel(), dist_differences[selected].ravel())
+    
+    def iong(self, ids, policy=0):
+        ''' Returns the IONG values of the given vehicles per method of a policy (in order of METHOD_NAMES).'''
+        return self.received_information.iong(ids)[self.policy_methods[policy]]
+    
+    def iong_table(self, policy=0):
+        '''
+            Returns the ids of every vehicle (in order of appearance) and their IONG values
+            per method of a policy (in order of METHOD_NAMES).
+        '''
+        if not(self.evict_finished):
+            ids = np.array(list(self.movement_tracker.movements), dtype=np.int64)
+            return ids, self.iong(ids, policy)
+        ids = np.concatenate(self._finished_ids + [self._active_ids])
+        iongs = np.concatenate(self._finished_iongs + [self.received_information.iong(self._active_ids)], axis=1)
+        order = np.argsort(ids, kind="stable")
+        return ids[order], iongs[self.policy_methods[policy]][:, order].astype(np.int64)
+
+    def _summarize_finished(self, ids):
+        ''' Adds the IONG of the vehicles that left the simulation since the last step to the summary
+            (and evicts them if evict_finished is set).'''
+        ids = np.asarray(ids, dtype=np.int64)
+        finished = np.setdiff1d(self._active_ids, ids)
+        if len(finished) > 0:
+            iongs = self.received_information.iong(finished)
+            for summary, methods in zip(self.summaries, self.policy_methods):
+                if not(summary is None):
+                    summary.add_iong(iongs[methods])
+            if self.evict_finished:
+                self._finished_ids.append(finished)
+                self._finished_iongs.append(iongs.astype(np.int32))
+        self._active_ids = ids.copy()
+        if self.evict_finished and (len(ids) > 0):
+            #the vehicles of smaller ids than the active ones have left:
+            self.movement_tracker.evict(ids.min())
+            self.received_information.evict(ids.min())
+    
+    def finish_summary(self):
+        ''' Adds the IONG of the vehicles still in the simulation to the summary.'''
+        if any(not(summary is None) for summary in self.summaries):
+            self._summarize_finished([])
         
+    def evaluate_deferred_events(self, chunk_size=2**16):
+        '''
+            Computes the correctness of the logged sharing events (in deferred evaluation mode)
+            in vectorized chunks, and stores them into the distance records in order of the events.
+            Parameters:
+                chunk_size: number of events evaluated together
+        '''
+        time_start = time.time()
+        events = self.sharing_events
+        for start in range(0, len(events), chunk_size):
+            chunk = slice(start, start+chunk_size)
+            senders = events.column("senders", chunk)
+            receivers = events.column("receivers", chunk)
+            distances, dist_differences = metrics.calculate_correctness_batch(
+                self.origin_guesses, self.distance_calculator,
+                self.movement_tracker.edges_at(senders, events.column("starts", chunk)),
+                self.movement_tracker.edges_at(senders, events.column("ends", chunk)-1),
+                self.movement_tracker.edges_at(receivers, np.zeros(len(receivers), dtype=np.int64)),
+                self.deferred_n)
+            self._append_records(events.column("times", chunk), receivers, events.column("methods", chunk),
+                                 distances, dist_differences)
+        self.sharing_events = SharingEvents()
+        self.times["distances"] = self.times["distances"] + (time.time()-time_start)
         
-    def _share_information(self, t, ids, routes):
+    def _share_information(self, t, receivers, senders):
         '''
-            This method handles the information sharing among two vehicles.
+            This method handles the information sharing of all meetings of a timestep.
             Parameters:
                 t: timestep
-                ids: ids of the two vehicles
-                routes: routes of the vehicles
+                receivers: ids of the receiver vehicles
+                senders: ids of the sender vehicles (senders[k] shares with receivers[k])
         '''
-        assert (len(ids) == 2) and (len(routes) == 2)
-        
         #calculating the amount of shared information:
-        uniform = [[],[]]
-        minprob = [[],[]]
-        last1   = [[],[]]
-        last2   = [[],[]]
-        last3   = [[],[]]
-        mix     = [[],[]]
-        
         t_start = time.time()
-        for i,_id in enumerate(ids):
-            uniform[i]= tell_decisions.tell_uniform(self.P, routes[i])
-            minprob[i]= tell_decisions.tell_min_prob(self.P, routes[i], self.o_dist, self.matrix_power, self.source_probs)
-            last1[i]= tell_decisions.tell_last_n(self.P, routes[i], 1)
-            last2[i]= tell_decisions.tell_last_n(self.P, routes[i], 2)
-            last3[i]= tell_decisions.tell_last_n(self.P, routes[i], 3)
-            mix[i]= tell_decisions.tell_mix(self.P, routes[i], self.o_dist, self.matrix_power, self.mix_n, self.source_probs)
-        
+        shared = tell_decisions.tell_tracked(self.movement_tracker, senders, self.policies[0], self.rng,
+                                             self.mix_rngs[0])
+        shared[self.method_names[len(METHOD_NAMES)-1]] = shared.pop("mix")
+        #the MIX decisions of the other policies:
+        for policy, name, rng in zip(self.policies[1:], self.method_names[len(METHOD_NAMES):], self.mix_rngs[1:]):
+            shared[name] = tell_decisions.tell_mix_tracked(self.movement_tracker, senders, policy, rng,
+                                                           shared["minprob"])
         self.times["tell_calc"] = self.times["tell_calc"] + (time.time()-t_start)
-            
-        #print(uniform[i],"\n", minprob[i], "\n", last1[i])
         
-        #storing results:
-        for i,_id in enumerate(ids):
-            if not(_id in self.received_information_uniform):
-                self.received_information_uniform[_id] = []
-                self.received_information_minprob[_id] = []
-                self.received_information_last1[_id] = []
-                self.received_information_last2[_id] = []
-                self.received_information_last3[_id] = []
-                self.received_information_mix[_id] = []
-            #stroring results, note that the calculated shared information of ego vehicle is the received information by alter
-            self.received_information_uniform[_id] = self.received_information_uniform[_id] + uniform[i-1]
-            self.received_information_minprob[_id] = self.received_information_minprob[_id] + minprob[i-1]
-            self.received_information_last1[_id] = self.received_information_last1[_id] + last1[i-1]
-            self.received_information_last2[_id] = self.received_information_last2[_id] + last2[i-1]
-            self.received_information_last3[_id] = self.received_information_last3[_id] + last3[i-1]
-            self.received_information_mix[_id] = self.received_information_mix[_id] + mix[i-1]
-            #storing distances = the loss of privacy caused by the sharing:
-            self._store_distances(t, _id,
-                    [uniform[i-1], minprob[i-1], last1[i-1], last2[i-1], last3[i-1], mix[i-1]],
-                    ["uniform", "minprob", "last1", "last2", "last3", "mix"],
-                                  self.movement_tracker.movements[_id][0])
+        #the shared segments are references into the routes of the senders:
+        ends = self.movement_tracker.lengths(senders)
+        starts = np.stack([ends-shared[name] for name in self.method_names], axis=1)
+        
+        #storing results, note that the calculated shared information of the sender is the received information by the receiver:
+        for i, name in enumerate(self.method_names):
+            self.received_information.receive(name, receivers,
+                                              self.movement_tracker.segments(senders, starts[:, i], ends),
+                                              shared[name])
+        #storing distances = the loss of privacy caused by the sharing (in order of the events, then methods):
+        n_methods = len(self.method_names)
+        self._store_distances(t, np.repeat(receivers, n_methods), np.repeat(senders, n_methods),
+                              np.tile(np.arange(n_methods), len(receivers)),
+                              starts.ravel(), np.repeat(ends, n_methods))
             
         
     def __call__(self, t, states, ids, remainings):
         #if t%20 == 0: print("Step %d"%t)
         self.movement_tracker(t, states, ids, remainings)
+        self.received_information.visit(ids, states)
+        if any(not(summary is None) for summary in self.summaries):
+            self._summarize_finished(ids)
         t_start = time.time()
         meetings = self.meeting_model(t, states, ids, remainings)
         self.times["meetings"] = self.times["meetings"] + (time.time()-t_start)
-        for x,y in meetings:
-            route_x = self.movement_tracker.movements[ids[x]]
-            route_y = self.movement_tracker.movements[ids[y]]
-            
-            #sharing information:
-            self._share_information(t, [ids[x],ids[y]], [route_x, route_y]) 
+        if len(meetings) == 0:
+            return
+        #[x,y] and [y,x] are the same meeting, keeping the first occurrence:
+        meetings = np.sort(np.asarray(meetings, dtype=np.int64), axis=1)
+        _, first = np.unique(meetings, axis=0, return_index=True)
+        meetings = meetings[np.sort(first)]
+        
+        #both vehicles of a meeting share their routes (x receives first):
+        receivers = np.asarray(ids)[meetings].ravel()
+        senders = np.asarray(ids)[meetings[:, ::-1]].ravel()
+        self._share_information(t, receivers, senders)
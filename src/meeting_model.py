@@ -2,6 +2,8 @@
 
 import re
 import numpy as np
+import scipy.sparse as sp
+from scipy.spatial import cKDTree
 
 def _get_to_junction(edge_name):
     '''
@@ -26,17 +28,161 @@ def _collect_neighborings(edge_names):
                 result[e].append(x)
     return result
 
-class Meeting:
-    neighbors = {}
-    neighbor_indices = {}
-    last_meetings = {}
+def _neighbor_matrix_from_names(edge_to_index_map, n_edges):
+    '''
+        Creates the (N, N) boolean matrix of neighboring edges from the edge names
+        (works only with the naming scheme of the grid networks).
+    '''
+    neighbors = _collect_neighborings(list(edge_to_index_map.keys()))
+    rows, cols = [], []
+    for edge in neighbors:
+        for e in neighbors[edge]:
+            rows.append(edge_to_index_map[edge])
+            cols.append(edge_to_index_map[e])
+    return sp.csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(n_edges, n_edges))
+
+def _collect_topological_neighborings(net, edge_to_index_map, n_edges, hops=0):
+    '''
+        Creates the (N, N) boolean matrix of neighboring edges from the network topology.
+        Parameters:
+            net: SUMO road network
+            edge_to_index_map: network edges -> indices of P
+            n_edges: size of the matrix
+            hops: number of additional edges between the neighbors
+        With hops=0, the neighbors of an edge are the edges incident to its to-node (both
+        incoming and outgoing ones). Each further hop extends the neighborhood with the edges
+        sharing a junction with the neighbors.
+    '''
+    node_to_index_map = {node.getID(): i for i, node in enumerate(net.getNodes())}
+    #incidence matrices of the edges and their to-nodes / endpoints:
+    edges, to_nodes, from_nodes = [], [], []
+    for edge_id, edge_idx in edge_to_index_map.items():
+        edge = net.getEdge(edge_id)
+        edges.append(edge_idx)
+        to_nodes.append(node_to_index_map[edge.getToNode().getID()])
+        from_nodes.append(node_to_index_map[edge.getFromNode().getID()])
+    shape = (n_edges, len(node_to_index_map))
+    ones = np.ones(len(edges))
+    to_incidence = sp.csr_matrix((ones, (edges, to_nodes)), shape=shape)
+    incidence = to_incidence + sp.csr_matrix((ones, (edges, from_nodes)), shape=shape)
     
-    def __init__(self, edge_to_index_map, index_to_edge_map):
-        self.neighbors = _collect_neighborings(list(edge_to_index_map.keys()))
-        #translating edge names to indices:
-        for edge in self.neighbors:
-            edge_idx = edge_to_index_map[edge]
-            self.neighbor_indices[edge_idx] = [edge_to_index_map[e] for e in self.neighbors[edge]]
+    neighbors = (to_incidence @ incidence.T) > 0
+    adjacency = ((incidence @ incidence.T) > 0).astype(float)
+    for _ in range(hops):
+        neighbors = (neighbors.astype(float) @ adjacency) > 0
+    return neighbors.tocsr()
+
+def _sample_edge_shapes(net, edge_to_index_map, spacing):
+    ''' Samples points along the edge shapes, at most spacing apart.
+        Returns the (K, 2) array of points and the index of their edges.'''
+    points, owners = [], []
+    for edge_id, edge_idx in edge_to_index_map.items():
+        shape = np.array(net.getEdge(edge_id).getShape(), dtype=float)
+        samples = [shape[:1]]
+        for a, b in zip(shape[:-1], shape[1:]):
+            n_samples = max(1, int(np.ceil(np.linalg.norm(b-a)/spacing)))
+            samples.append(a + np.outer(np.arange(1, n_samples+1)/n_samples, b-a))
+        samples = np.concatenate(samples)
+        points.append(samples)
+        owners.append(np.full(len(samples), edge_idx))
+    return np.concatenate(points), np.concatenate(owners)
+
+def _point_segment_distances(points, starts, ends):
+    ''' Distances of points[i] from the segment starts[i]-ends[i] (all are (K, 2) arrays).'''
+    directions = ends - starts
+    squared_lengths = np.einsum("ij,ij->i", directions, directions)
+    projections = np.einsum("ij,ij->i", points-starts, directions) / np.where(squared_lengths > 0, squared_lengths, 1)
+    closest = starts + np.clip(projections, 0, 1)[:, None]*directions
+    return np.linalg.norm(points-closest, axis=1)
+
+def _segment_distances(a0, a1, b0, b1):
+    ''' Minimum distances between the segments a0[i]-a1[i] and b0[i]-b1[i] (all are (K, 2) arrays).'''
+    cross = lambda u, v: u[:, 0]*v[:, 1] - u[:, 1]*v[:, 0]
+    #properly crossing segments:
+    crossing = ((cross(b1-b0, a0-b0) * cross(b1-b0, a1-b0) < 0) &
+                (cross(a1-a0, b0-a0) * cross(a1-a0, b1-a0) < 0))
+    #otherwise the minimum is taken at an endpoint:
+    distances = np.min([_point_segment_distances(a0, b0, b1), _point_segment_distances(a1, b0, b1),
+                        _point_segment_distances(b0, a0, a1), _point_segment_distances(b1, a0, a1)], axis=0)
+    return np.where(crossing, 0.0, distances)
+
+def _edge_distances(net, edge_to_index_map, n_edges, xs, ys):
+    ''' Exact minimum distances between the shapes of edges xs[i] and ys[i].'''
+    #segments of the edge shapes, in order of the edge indices:
+    shapes = [None]*n_edges
+    for edge_id, edge_idx in edge_to_index_map.items():
+        shapes[edge_idx] = np.array(net.getEdge(edge_id).getShape(), dtype=float)
+    n_segments = np.array([0 if shape is None else len(shape)-1 for shape in shapes])
+    segment_indptr = np.concatenate(([0], np.cumsum(n_segments)))
+    starts = np.concatenate([shape[:-1] for shape in shapes if not(shape is None)])
+    ends = np.concatenate([shape[1:] for shape in shapes if not(shape is None)])
+    #every segment pair of the edge pairs:
+    sizes = n_segments[xs]*n_segments[ys]
+    pair_index = np.repeat(np.arange(len(xs)), sizes)
+    k = np.arange(np.sum(sizes)) - np.repeat(np.cumsum(sizes)-sizes, sizes)
+    a = segment_indptr[xs][pair_index] + k // n_segments[ys][pair_index]
+    b = segment_indptr[ys][pair_index] + k % n_segments[ys][pair_index]
+    distances = _segment_distances(starts[a], ends[a], starts[b], ends[b])
+    return np.minimum.reduceat(distances, np.cumsum(sizes)-sizes) if len(xs) > 0 else distances
+
+def _collect_range_neighborings(net, edge_to_index_map, n_edges, radius):
+    '''
+        Creates the (N, N) boolean matrix of the edges being at most radius away from each other
+        (measured between the edge geometries). Candidate pairs are found by a KD-tree on points
+        sampled along the edges, then they are confirmed with the exact segment distances.
+    '''
+    if radius <= 0:
+        raise ValueError("meeting radius must be positive, got %s"%radius)
+    spacing = radius/2
+    points, owners = _sample_edge_shapes(net, edge_to_index_map, spacing)
+    #every point of a segment is at most spacing/2 away from a sample of its edge:
+    pairs = cKDTree(points).query_pairs(radius+spacing, output_type="ndarray")
+    candidates = np.unique(np.sort(np.stack((owners[pairs[:, 0]], owners[pairs[:, 1]]), axis=1), axis=1), axis=0)
+    candidates = candidates[candidates[:, 0] != candidates[:, 1]]
+    close = _edge_distances(net, edge_to_index_map, n_edges, candidates[:, 0], candidates[:, 1]) <= radius
+    xs, ys = candidates[close, 0], candidates[close, 1]
+    edges = np.unique(owners)
+    rows = np.concatenate((xs, ys, edges))
+    cols = np.concatenate((ys, xs, edges))
+    return sp.csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(n_edges, n_edges))
+
+def _concatenated_ranges(starts, lengths):
+    '''
+        Returns the concatenation of the [starts[i], starts[i]+lengths[i]) ranges
+        e.g. starts=[5, 0], lengths=[2, 3] -> [5, 6, 0, 1, 2]
+    '''
+    offsets = starts - np.cumsum(lengths) + lengths
+    return np.repeat(offsets, lengths) + np.arange(np.sum(lengths))
+
+class Meeting:
+    def __init__(self, edge_to_index_map, index_to_edge_map, net=None, radius=None, hops=0):
+        '''
+            Parameters:
+                edge_to_index_map: network edges -> indices of P
+                index_to_edge_map: indices of P -> network edges
+                net: SUMO road network, if None, neighbors are derived from the (grid) edge names
+                radius: if given, vehicles on edges at most radius [m] away from each other meet
+                hops: vehicles meet up to this many edges away from the shared junction
+                    (only without radius)
+        '''
+        n_edges = max(index_to_edge_map)+1
+        assert (radius is None) or (hops == 0), "meeting radius and meeting hops cannot be both set"
+        if net is None:
+            neighbors = _neighbor_matrix_from_names(edge_to_index_map, n_edges)
+        elif not(radius is None):
+            neighbors = _collect_range_neighborings(net, edge_to_index_map, n_edges, radius)
+        else:
+            neighbors = _collect_topological_neighborings(net, edge_to_index_map, n_edges, hops)
+        
+        #neighbors in CSR format: neighbor_edges[neighbor_indptr[e]:neighbor_indptr[e+1]]
+        neighbors = sp.csr_matrix(neighbors)
+        neighbors.sum_duplicates()
+        self.neighbor_indptr = neighbors.indptr.astype(np.int64)
+        self.neighbor_edges = neighbors.indices.astype(np.int64)
+        
+        #pairs of the previous call, encoded as x<<32 | y; older meetings do not block new ones:
+        self.last_meetings = np.array([], dtype=np.int64)
+        self.last_meeting_time = None
         
     def __call__(self, t, states, ids, remainings):
         '''
@@ -49,19 +195,29 @@ class Meeting:
             Returns:
                 list of [x,y] pairs, meaning vehicle x meets vehicle y ([x,y] and [y,x] are also contained. Vehicles are members of the actual simulation state, i.e. NOT IDs!)
         '''
-        results = []
-        for i,s in enumerate(states):
-            if s in self.neighbor_indices:
-                meetings = np.arange(0,len(states))[np.isin(states, self.neighbor_indices[s])] #ids with whom i car meets
-                for m in meetings:
-                    #no self meeting, no meeting in last steps:
-                    if (i!=m) and ((not str(i)+"_"+str(m) in self.last_meetings)
-                                   or (self.last_meetings[str(i)+"_"+str(m)] < t-1)):
-                        results.append([i, m])
-                        self.last_meetings[str(i)+"_"+str(m)] = t
-
+        states = np.asarray(states, dtype=np.int64)
+        n_edges = len(self.neighbor_indptr)-1
+        
+        #bucketing the vehicles by their edges (counting sort):
+        counts = np.bincount(states, minlength=n_edges)
+        bucket_starts = np.cumsum(counts) - counts
+        by_edge = np.argsort(states, kind="stable")
+        
+        #(vehicle, neighboring edge) pairs:
+        degrees = np.diff(self.neighbor_indptr)[states]
+        vehicles = np.repeat(np.arange(len(states)), degrees)
+        edges = self.neighbor_edges[_concatenated_ranges(self.neighbor_indptr[states], degrees)]
+        
+        #(vehicle, vehicle on the neighboring edge) pairs:
+        xs = np.repeat(vehicles, counts[edges])
+        ys = by_edge[_concatenated_ranges(bucket_starts[edges], counts[edges])]
+        
+        #no self meeting, no meeting in last steps:
+        not_self = xs != ys
+        pairs = np.sort((xs[not_self] << 32) | ys[not_self]) #in order of x, then y
+        if self.last_meeting_time == t-1:
+            pairs = pairs[~np.isin(pairs, self.last_meetings)]
+        self.last_meetings = pairs
+        self.last_meeting_time = t
         
-        return results
-                
-                    
-    
\ No newline at end of file
+        return np.stack((pairs >> 32, pairs & 0xFFFFFFFF), axis=1).tolist()
@@ -2,15 +2,16 @@
     the information sharing process. Also, it implemets some metrics for evaluation.'''
 
 import numpy as np
-import networkx as nx
+import scipy.sparse as sp
+import scipy.sparse.csgraph as csgraph
 
+import os
 import time
+import tempfile
 
 import sumolib
 
-from tools.utils import MatrixPower
-
-import torch
+from tools.utils import MatrixPower, VectorPropagation
 
 def calculate_source_probability(matrix_power: MatrixPower, P_b, t_r, p_length=None, d=None):
     ''' Computes the distribution of origins in the space of all edges of a network.
@@ -27,6 +28,10 @@ def calculate_source_probability(matrix_power: MatrixPower, P_b, t_r, p_length=N
     #assert (not (p_length is None)) or (not (d is None))
     
     answer = np.array([])
+    if isinstance(matrix_power, VectorPropagation):
+        n = d+1 if not(d is None) else len(p_length)
+        elements = matrix_power.propagate(np.reshape(t_r, (1, -1)), max_n=n)[:, 0]
+        return elements[d] if not(d is None) else np.asarray(p_length) @ elements
     if not(d is None):
         answer = t_r @ matrix_power(d)
     else:
@@ -41,44 +46,93 @@ def calculate_source_probability(matrix_power: MatrixPower, P_b, t_r, p_length=N
         
     return answer
 
+def _filled_memmap(path, dtype, shape, fill):
+    ''' Creates a memory-mapped .npy file filled by fill(array). It is written into a temporary file
+        first, which replaces path only when it is complete, so concurrent runs configured with the
+        same path never truncate each other's file. Returns the file memory-mapped read-only.'''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    os.close(fd)
+    try:
+        array = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=shape)
+        fill(array)
+        array.flush()
+        del array
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return np.load(path, mmap_mode="r")
+
 class SourceProbabilities:
     ''' Supports fast calculation of origin distributions by precalculating the results for each
-        edges.'''
-    def __init__(self, matrix_power: MatrixPower, P_b, p_length):
-        self.alter_sources = {}
-        self.ego_sources = {}
+        edges. Ego distributions are rows of the powers of P_b, stored in a single (D, N, N) tensor
+        (or looked up through a MatrixPower or VectorPropagation object), alter distributions are
+        the rows of the p_length-weighted sum of the powers.'''
+    def __init__(self, matrix_power: MatrixPower, P_b, p_length, tensor_path=None):
+        ''' Parameters:
+            matrix_power: a MatrixPower or VectorPropagation object serving the ego lookups (no
+                power tensor is stored), or None: the power tensor is calculated from P_b
+            P_b: transition matrix of the _backward_ Markov chain (dense or scipy.sparse)
+            p_length: model of path lengths
+            tensor_path: if given, the power tensor is stored in this memory-mapped .npy file
+                (only without matrix_power)'''
+        P_b_sparse = sp.csr_matrix(P_b)
+        n_lengths, n_edges = len(p_length), P_b_sparse.shape[0]
+        self.matrix_power = matrix_power
+        
+        def fill(power_tensor):
+            #power_tensor[d] = P_b^(d+1):
+            power_tensor[0] = P_b_sparse.toarray()
+            for d in range(1, n_lengths):
+                power_tensor[d] = P_b_sparse @ power_tensor[d-1]
+        
+        shape = (n_lengths, n_edges, n_edges)
+        if not(matrix_power is None):
+            self.power_tensor = None
+        elif tensor_path is None:
+            self.power_tensor = np.empty(shape)
+            fill(self.power_tensor)
+        else:
+            self.power_tensor = _filled_memmap(tensor_path, float, shape, fill)
+        #ego_sources[edge][d] is a view of power_tensor[d, edge]:
+        self.ego_sources = None if self.power_tensor is None else self.power_tensor.transpose(1, 0, 2)
         
-        cuda = torch.cuda.is_available()
-        mp = []
-        if cuda:
-            for d in range(len(p_length)):
-                mp.append(torch.from_numpy(matrix_power(d)).float().to("cuda"))
-                
-        for edge_idx in range(len(P_b)): #iterating through each edges:
-            self.ego_sources[edge_idx] = []
-            t_r = torch.zeros(len(P_b)) if torch.cuda.is_available() else np.zeros(len(P_b))
-            t_r[edge_idx] = 1.0
-            if cuda:
-                t_r = t_r.float().to("cuda")
-            #calculation
-            elements = []
-            for d in range(len(p_length)):
-                if cuda:
-                    with torch.no_grad():
-                        #mp = torch.from_numpy(matrix_power(d)).float().to("cuda")
-                        elem_ = (t_r @ mp[d]).to("cpu").numpy()
-                else:
-                    elem_ = t_r @ matrix_power(d)
-                self.ego_sources[edge_idx].append(elem_)
-                elements.append(elem_ * p_length[d])
-            elements = np.array(elements)
-            self.alter_sources[edge_idx] = np.sum(elements, axis=0)
+        #sum of p_length[d] * P_b^(d+1), evaluated by the Horner scheme:
+        #P_b @ (p_length[0]*I + P_b @ (p_length[1]*I + ... P_b @ (p_length[D-1]*I)))
+        diagonal = np.diag_indices(n_edges)
+        horner = np.zeros((n_edges, n_edges))
+        horner[diagonal] = p_length[-1]
+        for d in range(n_lengths-2, -1, -1):
+            horner = P_b_sparse @ horner
+            horner[diagonal] += p_length[d]
+        self.alter_sources = P_b_sparse @ horner
             
         print("Source probabilities have been calculated.")
+
+    @classmethod
+    def from_arrays(cls, power_tensor, alter_sources, matrix_power=None):
+        ''' Creates the object from previously calculated (e.g. memory-mapped) arrays.
+            Without power tensor, the ego lookups are served by matrix_power.'''
+        source_probs = cls.__new__(cls)
+        source_probs.matrix_power = matrix_power
+        source_probs.power_tensor = power_tensor
+        source_probs.ego_sources = None if power_tensor is None else power_tensor.transpose(1, 0, 2)
+        source_probs.alter_sources = alter_sources
+        return source_probs
+            
+    def ego_probabilities(self, known_edges, ds, origins):
+        ''' Vectorized ego lookup: returns self(known_edges[i], ds[i])[origins[i]] for every i.'''
+        if self.power_tensor is None:
+            return self.matrix_power.entries(known_edges, ds, origins)
+        return self.power_tensor[ds, known_edges, origins]
             
     def __call__(self, known_edge, d=None):
         #if not(d is None): print(d)
-        return self.alter_sources[known_edge] if d is None else self.ego_sources[known_edge][d]
+        if d is None:
+            return self.alter_sources[known_edge]
+        if self.power_tensor is None:
+            return self.matrix_power.row(known_edge, d)
+        return self.power_tensor[d, known_edge]
 
 
 
@@ -103,24 +157,95 @@ def _get_distance_between(net, indices, index_to_edge_map):
     return min([d1, d2])
 
 class DistanceCalculator:
-    '''Class for fast calculation of distances in a network'''
-    def __init__(self, P):
+    '''Class for fast calculation of distances in a network.
+       All-pairs distances are stored in a dense float32 matrix: length[x, y] = min(d(x, y), d(y, x)),
+       where d(x, y) is the driving distance from the end of edge x to the end of edge y.'''
+    def __init__(self, P, edge_lengths=None, path=None, block_size=256):
         ''' Parameters:
-            P: _forward_ transition matrix'''
-        graph = nx.DiGraph()
-        graph.add_nodes_from(range(len(P)))
-        for i in range(len(P)):
-            for j in range(len(P)):
-                if P[i][j] > 0: graph.add_edge(i,j)
-                
-        self.length = dict(nx.all_pairs_dijkstra_path_length(graph))
-        #print(self.length)
+            P: _forward_ transition matrix (dense or scipy.sparse)
+            edge_lengths: lengths of the edges [m] (if None, distances are measured in hops)
+            path: if given, the distance matrix is stored in this memory-mapped .npy file
+            block_size: number of source edges processed by one Dijkstra call'''
+        graph = sp.csr_matrix(P, dtype=float, copy=True)
+        graph.eliminate_zeros()
+        n_edges = graph.shape[0]
+        #stepping from edge i to edge j costs the length of j:
+        graph.data = (np.ones(len(graph.data)) if edge_lengths is None
+                      else np.asarray(edge_lengths, dtype=float)[graph.indices])
+        
+        def fill(length):
+            for start in range(0, n_edges, block_size):
+                sources = np.arange(start, min(start+block_size, n_edges))
+                length[sources] = csgraph.dijkstra(graph, directed=True, indices=sources)
+            #symmetrizing in place (min of the two directions):
+            for start in range(0, n_edges, block_size):
+                block = slice(start, min(start+block_size, n_edges))
+                length[block] = np.minimum(length[block], length[:, block].T)
+        
+        if path is None:
+            self.length = np.empty((n_edges, n_edges), dtype=np.float32)
+            fill(self.length)
+        else:
+            self.length = _filled_memmap(path, np.float32, (n_edges, n_edges), fill)
+
+    @classmethod
+    def from_array(cls, length):
+        ''' Creates the object from a (N, N) distance matrix (e.g. a memory-mapped one).'''
+        distance_calculator = cls.__new__(cls)
+        distance_calculator.length = length
+        return distance_calculator
+
+    def to_array(self):
+        ''' Returns the (N, N) distance matrix, unreachable pairs are inf.'''
+        return self.length
         
     def __call__(self, x, y):
-        return min(self.length[x][y], self.length[y][x])
+        ''' x and y may be edge indices or arrays of edge indices (batched lookup).'''
+        return self.length[x, y]
+
+
+class OriginGuessIndex:
+    ''' Stores the n most likely origins of every edge (i.e. the best guesses of alter, knowing
+        only one edge of ego's route), in order from the best to the worst guess.'''
+    def __init__(self, source_probs, n=10, block_size=1024):
+        ''' Parameters:
+            source_probs: a SourceProbabilities object
+            n: number of guesses stored per edge
+            block_size: number of edges processed together'''
+        alter_sources = source_probs.alter_sources
+        n_edges = alter_sources.shape[0]
+        self.n = min(n, alter_sources.shape[1])
+        self.bests = np.empty((n_edges, self.n), dtype=np.int64)
+        for start in range(0, n_edges, block_size):
+            probs = np.asarray(alter_sources[start:start+block_size])
+            candidates = np.argpartition(-probs, self.n-1, axis=1)[:, :self.n]
+            order = np.argsort(-np.take_along_axis(probs, candidates, axis=1), axis=1, kind="stable")
+            self.bests[start:start+block_size] = np.take_along_axis(candidates, order, axis=1)
+
+    def __call__(self, known_edge, n=None):
+        ''' known_edge may be an edge index or an array of edge indices.'''
+        return self.bests[known_edge, :n]
 
 
-def calculate_correctness_best_n(net, index_to_edge_map, matrix_power: MatrixPower, P_b, route, p_length, starting_edge_index, source_probs, n=1, distance_calculator=None,):
+def calculate_correctness_batch(origin_guesses, distance_calculator, first_edges, last_edges, starting_edges, n=1):
+    ''' Computes correctness of a malicious alter for many shared routes at once.
+        Parameters:
+            origin_guesses: an OriginGuessIndex object
+            distance_calculator: a DistanceCalculator object
+            first_edges: first edges of the shared routes
+            last_edges: last edges of the shared routes
+            starting_edges: the first edges of ego's true routes
+            n: how many guesses to check (in order from best to worst guess)
+        Returns:
+            distances and distance differences, both of shape (len(first_edges), n)'''
+    starting_edges = np.reshape(starting_edges, (-1, 1))
+    distances = distance_calculator(starting_edges, origin_guesses(first_edges, n))
+    dist_differences = distances - distance_calculator(starting_edges, origin_guesses(last_edges, n))
+    return distances, dist_differences
+
+
+def calculate_correctness_best_n(net, index_to_edge_map, matrix_power: MatrixPower, P_b, route, p_length, starting_edge_index, source_probs, n=1, distance_calculator=None,
+                                 origin_guesses=None):
     ''' Computes correctness of a malicious alter. 
         Parameters:
             net: SUMO network object
@@ -133,6 +258,7 @@ def calculate_correctness_best_n(net, index_to_edge_map, matrix_power: MatrixPow
             source_probs: precomputed probabilities of origin edges (for faster run)
             n: how many indices to check (in order from best to worst guess)
             distance_calculator: a distance calculator object (for faster run)
+            origin_guesses: an OriginGuessIndex object with at least n guesses (for faster run)
             
         Returns:
             the distances between the selected N points'''
@@ -143,6 +269,12 @@ def calculate_correctness_best_n(net, index_to_edge_map, matrix_power: MatrixPow
     #tr[route[0]] = 1.0
     times = {"source_p": 0, "distances": 0}
     t_start = time.time()
+    
+    if not(origin_guesses is None) and not(distance_calculator is None) and (n <= origin_guesses.n):
+        distances, dist_differences = calculate_correctness_batch(origin_guesses, distance_calculator,
+                                                                  route[0], route[-1], starting_edge_index, n)
+        times["distances"] = time.time() - t_start
+        return distances[0], dist_differences[0], times
         
     t0 = source_probs(known_edge = route[0])
     tc_0 = source_probs(known_edge = route[-1])
@@ -164,7 +296,8 @@ def calculate_correctness_best_n(net, index_to_edge_map, matrix_power: MatrixPow
 
 
 def compute_iong(actual_route, gathered_information):
-    ''' Computes the Information-Otherwise-Not-Gained metric
+    ''' Computes the Information-Otherwise-Not-Gained metric (the reference of the bitset
+        accounting of measurement_tool.ReceivedInformation)
         Parameters:
             actual_route: list of the edges along a route of a vehicle
             gathered_information: list of the received edges
@@ -1,14 +1,171 @@
 '''This module implements a movement tracker object.'''
 
+import numpy as np
+
+class Movements:
+    '''
+        Read-only, dict-like view of the tracked routes: movements[_id] is the route
+        of vehicle _id as an array view (in order of time).
+    '''
+    def __init__(self, tracker):
+        self.tracker = tracker
+
+    def __getitem__(self, _id):
+        if not(_id in self):
+            raise KeyError(_id)
+        slot = _id - self.tracker.base_id
+        return self.tracker.routes[slot, :self.tracker.route_lengths[slot]]
+
+    def __contains__(self, _id):
+        slot = _id - self.tracker.base_id
+        return (0 <= slot < len(self.tracker.route_lengths)) and (self.tracker.route_lengths[slot] > 0)
+
+    def __iter__(self):
+        #vehicle ids are given in order of appearance:
+        return iter((np.flatnonzero(self.tracker.route_lengths > 0) + self.tracker.base_id).tolist())
+
+    def __len__(self):
+        return int(np.count_nonzero(self.tracker.route_lengths))
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(_id, self[_id]) for _id in self]
+
+
 class MovementTracker:
-    
-    def __init__(self):
-        self.movements = {}
-    
+    '''
+        Tracks the routes of the vehicles in a preallocated (slots, max_len) int32 buffer.
+        Vehicle ids (non-negative integers, as given by the simulator) minus base_id are used as
+        slot indices; evict() moves base_id forward and releases the slots of the left vehicles.
+    '''
+    def __init__(self, predecessors=None, o_dist=None, source_probs=None,
+                 max_len=64, capacity=1024, turn_memory=4):
+        '''
+            Parameters:
+                predecessors: most likely previous edge of every edge
+                    (None: the tell state of the vehicles is not maintained)
+                o_dist: origin distribution (needed by the min-prob cut points)
+                source_probs: a SourceProbabilities object (needed by the min-prob cut points)
+                max_len: initial route length capacity (it is doubled if a route is longer)
+                capacity: initial number of vehicle slots (it is doubled if needed)
+                turn_memory: number of stored last street changes per vehicle
+        '''
+        self.predecessors = predecessors
+        self.o_dist = None if o_dist is None else np.asarray(o_dist)
+        self.source_probs = source_probs
+        self.turn_memory = turn_memory
+        self.routes = np.zeros((capacity, max_len), dtype=np.int32)
+        self.route_lengths = np.zeros(capacity, dtype=np.int64)
+        #last positions of the street changes of the routes (ring buffer per vehicle):
+        self.turns = np.zeros((capacity, turn_memory), dtype=np.int64)
+        self.turn_counts = np.zeros(capacity, dtype=np.int64)
+        #last position of the routes where the finding probability is too high:
+        self.min_prob_cuts = np.zeros(capacity, dtype=np.int64)
+        #id of the vehicle in the first slot:
+        self.base_id = 0
+        self.movements = Movements(self)
+
+    def _slots(self, ids):
+        return np.asarray(ids, dtype=np.int64) - self.base_id
+
+    def _reserve(self, max_id, max_len):
+        ''' Grows the buffers to store vehicle max_id and routes of max_len length.'''
+        capacity, length = self.routes.shape
+        if max_id >= capacity:
+            capacity = max(2*capacity, max_id+1)
+            for name in ["route_lengths", "turns", "turn_counts", "min_prob_cuts"]:
+                old = getattr(self, name)
+                new = np.zeros((capacity,)+old.shape[1:], dtype=old.dtype)
+                new[:len(old)] = old
+                setattr(self, name, new)
+        if max_len > length:
+            length = max(2*length, max_len)
+        if self.routes.shape != (capacity, length):
+            routes = np.zeros((capacity, length), dtype=np.int32)
+            routes[:self.routes.shape[0], :self.routes.shape[1]] = self.routes
+            self.routes = routes
+
     def __call__(self, t, states, ids, remainings):
-        for i,_id in enumerate(ids):
-            if _id in self.movements:
-                self.movements[_id].append(int(states[i]))
-            else:
-                self.movements[_id] = [int(states[i])]
-                
\ No newline at end of file
+        if len(ids) == 0:
+            return
+        ids = self._slots(ids)
+        states = np.asarray(states, dtype=np.int64)
+        self._reserve(ids.max(), 0)
+        positions = self.route_lengths[ids]
+        self._reserve(0, positions.max()+1)
+        self.routes[ids, positions] = states
+        self.route_lengths[ids] = positions+1
+        if not(self.predecessors is None):
+            self._update_tell_state(states, ids, positions)
+
+    def _update_tell_state(self, states, ids, positions):
+        ''' Updates the tell state of the vehicles (given by their slots) with their newly appended edges.'''
+        previous = self.routes[ids, np.maximum(positions-1, 0)]
+        #a street changes where the vehicle did not come from the most likely previous edge:
+        turning = (positions >= 2) & (self.predecessors[states] != previous)
+        turned = ids[turning]
+        self.turns[turned, self.turn_counts[turned] % self.turn_memory] = positions[turning]
+        self.turn_counts[turned] += 1
+        if self.source_probs is None:
+            return
+        checked = np.flatnonzero(positions >= 1)
+        origins = self.routes[ids[checked], 0].astype(np.int64)
+        stops = (self.source_probs.ego_probabilities(states[checked], positions[checked], origins)
+                 > self.o_dist[origins])
+        self.min_prob_cuts[ids[checked[stops]]] = positions[checked[stops]]
+
+    def evict(self, first_id):
+        '''
+            Releases the slots of the vehicles with smaller ids than first_id
+            (they must have left the simulation). The buffers are compacted when at least
+            half of their slots are released.
+        '''
+        released = min(first_id - self.base_id, len(self.route_lengths))
+        if released <= 0:
+            return
+        self.route_lengths[:released] = 0
+        if 2*released < len(self.route_lengths):
+            return
+        for name in ["routes", "route_lengths", "turns", "turn_counts", "min_prob_cuts"]:
+            buffer = getattr(self, name)
+            kept = buffer[released:].copy()
+            buffer[:len(kept)] = kept
+            buffer[len(kept):] = 0
+        self.base_id += released
+
+    def lengths(self, ids):
+        ''' Returns the route lengths of the given vehicles.'''
+        return self.route_lengths[self._slots(ids)]
+
+    def edges_at(self, ids, positions):
+        ''' Returns the edges at the given positions of the routes of the given vehicles.'''
+        return self.routes[self._slots(ids), positions].astype(np.int64)
+
+    def segments(self, ids, starts, ends):
+        ''' Resolves segment references: returns route of ids[k] [starts[k]:ends[k]] concatenated.'''
+        ids = self._slots(ids)
+        lengths = ends-starts
+        positions = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+        return self.routes[np.repeat(ids, lengths), positions + np.arange(positions.size)].astype(np.int64)
+
+    def nth_last_turns(self, ids, n):
+        '''
+            Returns the position of the n-th last street change of the given vehicles
+            (-1 if a route has less street changes).
+            Parameters:
+                ids: vehicle ids
+                n: a scalar or one value per vehicle (at most turn_memory)
+        '''
+        ids = self._slots(ids)
+        n = np.broadcast_to(n, ids.shape)
+        assert np.all(n <= self.turn_memory)
+        counts = self.turn_counts[ids]
+        answer = self.turns[ids, (counts-n) % self.turn_memory]
+        return np.where(counts >= n, answer, -1)
+
+    def min_prob_lengths(self, ids):
+        ''' Returns the number of edges shared by the min-prob method of the given vehicles.'''
+        ids = self._slots(ids)
+        return self.route_lengths[ids] - self.min_prob_cuts[ids]
@@ -0,0 +1,168 @@
+'''Runs Monte Carlo replications of a measurement on a process pool.
+
+Replication r gets the r-th child of the seed (np.random.SeedSequence), which is spawned
+further into the random streams of its components (see measurement.random_streams), so the
+replications are bit-identical whatever the number of workers.
+The replications stop early when the confidence intervals of the per-method means of the
+privacy loss ("Alter correctness") and of IONG are narrower than the target widths. The
+stopping rule is checked on the replications in order, so the stopping point does not depend
+on the number of workers either. The results are written into
+    <result_root>/rep<r>/ (results of the replications)
+    <result_root>/replications.json (per-replication means and the confidence intervals)
+
+Example:
+    python3 replicate.py ../cfg/asymmetric_low.json ../results/replications/ -n 1 2 3 -s 42 -R 50 --privacy_width 20 --iong_width 1
+'''
+
+import os
+import json
+import time
+import argparse
+import concurrent.futures
+
+import numpy as np
+import scipy.stats
+
+import measurement
+
+#metric name in summary.json -> key of its target width:
+METRICS = {"Alter correctness": "privacy", "IONG": "iong"}
+
+
+def replication_seeds(seed, n_replications):
+    ''' Returns the seeds (np.random.SeedSequence) of the replications.'''
+    return np.random.SeedSequence(seed).spawn(n_replications)
+
+
+def confidence_intervals(means, confidence=0.95):
+    '''
+        Student-t confidence intervals of the mean of per-replication values.
+        Parameters:
+            means: (replications, ...) array of per-replication means
+            confidence: confidence level
+        Returns:
+            mean, width (full width of the intervals, inf with less than 2 replications)
+    '''
+    means = np.asarray(means, dtype=np.float64)
+    n = len(means)
+    if n < 2:
+        return means.mean(axis=0), np.full(means.shape[1:], np.inf)
+    t = scipy.stats.t.ppf(0.5+confidence/2, n-1)
+    return means.mean(axis=0), 2*t*means.std(axis=0, ddof=1)/np.sqrt(n)
+
+
+def _run(job):
+    config, config_file, mix_n, path, seed = job
+    os.makedirs(path, exist_ok=True)
+    start = time.time()
+    measurement.run_measurement(config, path, mix_n, config_file, seed)
+    with open(path+"summary.json") as f:
+        summary = json.load(f)
+    means = {metric: {method: s["mean"] for method, s in summary[metric].items()} for metric in METRICS}
+    return means, time.time()-start
+
+
+def _converged(means, methods, widths, confidence):
+    answer = {}
+    for metric, key in METRICS.items():
+        values = [[rep[metric][method] for method in methods] for rep in means]
+        mean, width = confidence_intervals(values, confidence)
+        answer[metric] = {method: {"mean": m, "width": w} for method, m, w in zip(methods, mean, width)}
+    #metrics without target width do not stop the replications, without any targets they all run:
+    targets = {metric: key for metric, key in METRICS.items() if not(widths[key] is None)}
+    done = (len(targets) > 0) and all(np.all(np.array([s["width"] for s in answer[metric].values()]) <= widths[key])
+                                      for metric, key in targets.items())
+    return done, answer
+
+
+def replicate(config, mix_n, result_root, n_replications, seed, privacy_width=None, iong_width=None,
+              confidence=0.95, min_replications=3, workers=None, config_file=None):
+    '''
+        Runs replications of a configuration until the confidence intervals are narrow enough.
+        Parameters:
+            config: measurement configuration (without "artifact_cache_dir", the artifacts are
+                cached in <result_root>/.artifacts)
+            mix_n: n values for the MIX method
+            result_root: result directory of the replications (with a trailing separator)
+            n_replications: maximal number of replications
+            seed: integer seed of the replications
+            privacy_width, iong_width: target widths of the confidence intervals of the means of
+                the privacy loss [m] and IONG of every method (None: no target)
+            confidence: confidence level of the intervals
+            min_replications: the stopping rule is checked from this many replications
+            workers: number of worker processes (None: number of CPUs)
+            config_file: name of the configuration file (stored in the metadata of the results)
+        Returns:
+            the replications.json content: the per-replication means, the confidence intervals
+            and the number of used replications
+    '''
+    config = dict(config)
+    #the per-replication means are read from the summaries:
+    config["summary_statistics"] = True
+    #the replications share the precomputed artifacts:
+    config.setdefault("artifact_cache_dir", os.path.join(result_root, ".artifacts"))
+    measurement.prepare_artifacts(config)
+    widths = {"privacy": privacy_width, "iong": iong_width}
+    jobs = [(config, config_file, mix_n, os.path.join(result_root, "rep%d"%r) + os.sep, rep_seed)
+            for r, rep_seed in enumerate(replication_seeds(seed, n_replications))]
+    methods = measurement.measurement_tool.METHOD_NAMES
+
+    results = {}
+    means = []
+    done, intervals = False, None
+    workers = os.cpu_count() if workers is None else workers
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        submitted = 0
+        while not(done) and (len(means) < n_replications):
+            #keeping every worker busy:
+            while (submitted < n_replications) and (len(pending) < workers):
+                pending[pool.submit(_run, jobs[submitted])] = submitted
+                submitted += 1
+            finished, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                r = pending.pop(future)
+                results[r], run_time = future.result()
+                print("Replication {} finished in {} seconds".format(r, run_time))
+            #checking the stopping rule on the replications in order:
+            while not(done) and (len(means) in results):
+                means.append(results[len(means)])
+                if len(means) >= min_replications:
+                    done, intervals = _converged(means, methods, widths, confidence)
+        for future in pending:
+            future.cancel()
+
+    if intervals is None:
+        _, intervals = _converged(means, methods, widths, confidence)
+    answer = {"seed": seed, "mix_n": mix_n, "confidence": confidence,
+              "target widths": {metric: widths[key] for metric, key in METRICS.items()},
+              "converged": bool(done), "replications": len(means),
+              "means": means, "intervals": intervals}
+    with open(os.path.join(result_root, "replications.json"), "w") as f:
+        json.dump(answer, f)
+    return answer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_file", type=str, help="configuration json file")
+    parser.add_argument("result_root", type=str, help="result directory of the replications")
+    parser.add_argument("-n", "--mix_n", nargs="+", required=True, help="n values for mix method")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="seed of the replications")
+    parser.add_argument("-R", "--replications", type=int, default=30, help="maximal number of replications")
+    parser.add_argument("--privacy_width", type=float, default=None,
+                        help="target confidence interval width of the mean privacy loss [m]")
+    parser.add_argument("--iong_width", type=float, default=None,
+                        help="target confidence interval width of the mean IONG")
+    parser.add_argument("--confidence", type=float, default=0.95, help="confidence level")
+    parser.add_argument("--min_replications", type=int, default=3,
+                        help="the stopping rule is checked from this many replications")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="number of worker processes")
+
+    args = parser.parse_args()
+    with open(args.config_file) as f:
+        config = json.load(f)
+    answer = replicate(config, [int(n) for n in args.mix_n], os.path.join(args.result_root, ""),
+                       args.replications, args.seed, args.privacy_width, args.iong_width,
+                       args.confidence, args.min_replications, args.workers, args.config_file)
+    print("{} replications, converged: {}".format(answer["replications"], answer["converged"]))
@@ -1,6 +1,51 @@
 import numpy as np
+import scipy.sparse as sp
 
-def sample_chain(P_mc, states):
-    '''Samples a Markov Chain'''
-    return [np.random.choice(range(len(P_mc)), 1, p = P_mc[int(state)])[0]
-        for state in states]
\ No newline at end of file
+def sample_chain(P_mc, states, rng=None):
+    '''Samples a Markov Chain (rng: a np.random.Generator, None: the global np.random state)'''
+    rng = np.random if rng is None else rng
+    return [rng.choice(range(len(P_mc)), 1, p = P_mc[int(state)])[0]
+        for state in states]
+
+
+class BatchSampler:
+    '''
+        Samples a Markov Chain for all states at once.
+        The cumulative distributions of the rows are precomputed from the (sparse) transition
+        matrix; row i is shifted to the (i, i+1] interval, so one searchsorted call finds the
+        next state of every vehicle.
+        States without outgoing transitions are kept in place.
+    '''
+    def __init__(self, P_mc, rng=None):
+        ''' Parameters:
+            P_mc: transition matrix of the Markov Chain (dense or scipy.sparse)
+            rng: a np.random.Generator (None: the global np.random state, so np.random.seed
+                makes the sampling reproducible)'''
+        P = sp.csr_matrix(P_mc, dtype=float, copy=True)
+        P.eliminate_zeros()
+        #np.random.random and Generator.random have the same interface:
+        self.rng = np.random if rng is None else rng
+        self.next_states = P.indices
+        self.row_starts = P.indptr[:-1]
+        self.row_ends = P.indptr[1:]
+
+        row_lengths = np.diff(P.indptr)
+        rows = np.repeat(np.arange(P.shape[0]), row_lengths)
+        cumulated = np.cumsum(P.data)
+        row_offsets = np.concatenate(([0.0], cumulated))[self.row_starts]
+        row_sums = np.concatenate(([0.0], cumulated))[self.row_ends] - row_offsets
+        cdf = (cumulated - np.repeat(row_offsets, row_lengths)) / np.repeat(row_sums, row_lengths)
+        cdf[self.row_ends[row_lengths > 0]-1] = 1.0 #no rounding errors at the end of the rows
+        self.cdf = rows + cdf
+
+    def __call__(self, states):
+        ''' Returns the next state of each element of states.'''
+        states = np.asarray(states, dtype=np.int64)
+        if len(states) == 0:
+            return states
+        positions = np.searchsorted(self.cdf, states + self.rng.random(len(states)), side="right")
+        positions = np.clip(positions, self.row_starts[states], self.row_ends[states]-1)
+        answer = self.next_states[positions]
+        absorbing = self.row_starts[states] == self.row_ends[states]
+        answer[absorbing] = states[absorbing]
+        return answer
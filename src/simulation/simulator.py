@@ -12,68 +12,118 @@ class Simulator:
         The simulator needs a path-length model (distribution)
         The simulator needs a call-back method.
     '''
-    states = np.array([])
-    remainings = np.array([])
-    ids = np.array([])
-    act_id = 0
-
-    def __init__(self, transition_mtx, feeding_model, inital_state_model, path_length_model, terminating_edges=None):
+    def __init__(self, transition_mtx, feeding_model, inital_state_model, path_length_model, terminating_edges=None,
+                 rng=None, capacity=1024, new_vehicle_rng=None):
+        '''
+            Parameters:
+                transition_mtx: transition matrix of the Markov Chain (dense or scipy.sparse)
+                feeding_model: number of new elements in each timestep
+                inital_state_model: distribution of the initial states
+                path_length_model: distribution of the path lengths
+                terminating_edges: elements reaching these states leave in the next step
+                rng: np.random.Generator used for sampling the movements (None: the global np.random state)
+                capacity: initial size of the vehicle state arrays (doubled when needed)
+                new_vehicle_rng: np.random.Generator used for sampling the initial states and
+                    path lengths of the new vehicles (None: the global np.random state)
+        '''
         self.transition_mtx = transition_mtx
+        self.sampler = sampler.BatchSampler(transition_mtx, rng)
+        #np.random.choice and Generator.choice have the same interface:
+        self.new_vehicle_rng = np.random if new_vehicle_rng is None else new_vehicle_rng
         self.feeding_model = feeding_model
         self.initial_state_model = inital_state_model
         self.path_length_model = path_length_model
         self.state_space_size = len(self.initial_state_model)
-        self.ids = []
-        self.terminating_edges = terminating_edges
+        self.terminating_edges = None if terminating_edges is None else np.asarray(terminating_edges)
+        
+        #vehicles are stored in the first n_active slots of preallocated arrays (in order of arrival):
+        self.capacity = capacity
+        self._states = np.zeros(capacity, dtype=np.int64)
+        self._remainings = np.zeros(capacity, dtype=np.int64)
+        self._ids = np.zeros(capacity, dtype=np.int64)
+        self.n_active = 0
+        self.act_id = 0
+
+    @property
+    def states(self):
+        return self._states[:self.n_active]
+
+    @property
+    def remainings(self):
+        return self._remainings[:self.n_active]
+
+    @property
+    def ids(self):
+        return self._ids[:self.n_active]
+
+    def _reserve(self, n_vehicles):
+        ''' Grows the state arrays geometrically until n_vehicles fit into them.'''
+        if n_vehicles <= self.capacity:
+            return
+        while self.capacity < n_vehicles:
+            self.capacity *= 2
+        for name in ["_states", "_remainings", "_ids"]:
+            grown = np.zeros(self.capacity, dtype=np.int64)
+            grown[:self.n_active] = getattr(self, name)[:self.n_active]
+            setattr(self, name, grown)
+
+    def _remove_finished(self):
+        ''' Removes the elements without remaining steps, keeping the order of the others.'''
+        keep = np.flatnonzero(self.remainings > 0)
+        n_kept = len(keep)
+        if n_kept < self.n_active:
+            self._states[:n_kept] = self._states[keep]
+            self._remainings[:n_kept] = self._remainings[keep]
+            self._ids[:n_kept] = self._ids[keep]
+            self.n_active = n_kept
 
     def simulate(self, n_steps=None, callback_function=None):
         '''
             Executes simulation steps.
             Parameters:
                 n_steps: the number of steps to execute. If None, execute until completion
-                call_back_function(timestep, states): function to call within each simulation step. 
+                call_back_function(timestep, states, ids, remainings): function to call within each simulation step.
+                    The arrays are views of the simulator state, valid only during the call.
         '''
 
         def _step(t):
             #adding new elements:
             num_news = int(self.feeding_model[t]) if t<len(self.feeding_model) else 0
-            new_states = np.random.choice(range(self.state_space_size),
+            new_states = self.new_vehicle_rng.choice(range(self.state_space_size),
                 num_news,
                 p=self.initial_state_model)
-            new_states = np.array(new_states, dtype=int)
-            new_remainings = np.random.choice(range(len(self.path_length_model)),
+            new_remainings = self.new_vehicle_rng.choice(range(len(self.path_length_model)),
                 num_news,
                 p=self.path_length_model)
-            new_ids = np.array(range(self.act_id, self.act_id+num_news))
             
-            self.states = np.append(self.states, [new_states])
-            self.remainings = np.append(self.remainings, [new_remainings])
-            self.ids = np.append(self.ids, [new_ids])
+            #adding them after the active vehicles:
+            self._reserve(self.n_active+num_news)
+            news = slice(self.n_active, self.n_active+num_news)
+            self._states[news] = new_states
+            self._remainings[news] = new_remainings
+            self._ids[news] = np.arange(self.act_id, self.act_id+num_news)
+            self.n_active += num_news
             self.act_id += num_news
 
-            #running the callback:
+            #running the callback (on views of the active vehicles):
             callback_function(t, self.states, self.ids, self.remainings)
 
             #executing movements:
-            self.states = sampler.sample_chain(self.transition_mtx, self.states)
-            self.states = np.array(self.states, dtype=int)
-            self.remainings = self.remainings - 1 #everyone has stepped one
+            self.states[:] = self.sampler(self.states)
+            self.remainings[:] -= 1 #everyone has stepped one
 
             #preventing leaving vehicles to reenter:
             if not(self.terminating_edges is None):
-                for term in self.terminating_edges:
-                    self.remainings[self.states == term] = 1
+                self.remainings[np.isin(self.states, self.terminating_edges)] = 1
 
             #remove finished elements:
-            self.states = np.delete(self.states, self.remainings<=0)
-            self.ids = np.delete(self.ids, self.remainings<=0)
-            self.remainings = np.delete(self.remainings, self.remainings<=0)
+            self._remove_finished()
 
         _step(0)
         t = 1
         
         pbar = tqdm(total=n_steps if not(n_steps is None) else len(self.feeding_model)+len(self.path_length_model))
-        while ((n_steps is None) and (len(self.states)>0)) or (not(n_steps is None) and (t<n_steps)):
+        while ((n_steps is None) and (self.n_active>0)) or (not(n_steps is None) and (t<n_steps)):
             _step(t)
             t += 1
             pbar.update(1)
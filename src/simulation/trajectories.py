@@ -0,0 +1,162 @@
+'''Recording and replaying the trajectories of the simulator.
+
+A recorded trajectory is a directory of chunks; a chunk stores consecutive timesteps:
+    states_<k>.npy, ids_<k>.npy, remainings_<k>.npy: the rows of the steps concatenated,
+    offsets_<k>.npy: start of the rows of every step (and the end of the last one),
+and meta.json lists the chunks with their first timesteps (and the metadata of the recording). The .npy files are memory-mapped
+when they are replayed.'''
+
+import os
+import json
+import concurrent.futures
+
+import numpy as np
+
+
+class TrajectoryRecorder:
+    '''
+        Simulator callback that records the per-step vehicle states, ids and remaining steps,
+        optionally forwarding them to another callback.
+    '''
+    def __init__(self, path, callback=None, chunk_rows=2**20, metadata=None):
+        '''
+            Parameters:
+                path: directory of the recorded trajectory
+                callback: callback called after recording each step (None: only recording)
+                chunk_rows: a chunk is written when it has at least this many rows
+                metadata: json serializable data stored with the trajectory (e.g. the seed of the run)
+        '''
+        self.path = path
+        self.metadata = metadata
+        self.callback = callback
+        self.chunk_rows = chunk_rows
+        os.makedirs(path, exist_ok=True)
+        self.chunks = [] #first timesteps of the written chunks
+        self.n_steps = 0
+        self._new_chunk()
+
+    def _new_chunk(self):
+        self._first_step = None
+        self._rows = []
+        self._n_rows = 0
+
+    def __call__(self, t, states, ids, remainings):
+        assert t == self.n_steps, "timesteps are recorded in order"
+        if self._first_step is None:
+            self._first_step = t
+        #copies, since the arrays of the simulator are reused:
+        self._rows.append((np.array(states, dtype=np.int32), np.array(ids, dtype=np.int64),
+                           np.array(remainings, dtype=np.int32)))
+        self._n_rows += len(ids)
+        self.n_steps += 1
+        if self._n_rows >= self.chunk_rows:
+            self._flush()
+        if not(self.callback is None):
+            self.callback(t, states, ids, remainings)
+
+    def _flush(self):
+        if self._first_step is None:
+            return
+        k = len(self.chunks)
+        lengths = [len(ids) for _, ids, _ in self._rows]
+        for i, name in enumerate(["states", "ids", "remainings"]):
+            np.save(os.path.join(self.path, "%s_%05d.npy"%(name, k)), np.concatenate([row[i] for row in self._rows]))
+        np.save(os.path.join(self.path, "offsets_%05d.npy"%k), np.concatenate(([0], np.cumsum(lengths))))
+        self.chunks.append(self._first_step)
+        self._new_chunk()
+
+    def close(self):
+        ''' Writes the last chunk and the metadata (it marks the recording complete).'''
+        self._flush()
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump({"n_steps": self.n_steps, "chunks": self.chunks, "metadata": self.metadata}, f)
+
+
+class Trajectory:
+    '''A recorded trajectory (memory-mapped).'''
+    def __init__(self, path):
+        ''' Parameters:
+            path: directory of the recorded trajectory'''
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.n_steps = meta["n_steps"]
+        self.chunk_starts = meta["chunks"]
+        self.metadata = meta.get("metadata")
+
+    def _load(self, name, k):
+        return np.load(os.path.join(self.path, "%s_%05d.npy"%(name, k)), mmap_mode="r")
+
+    def chunk_steps(self, k):
+        ''' Returns the timesteps of the kth chunk.'''
+        end = self.chunk_starts[k+1] if k+1 < len(self.chunk_starts) else self.n_steps
+        return range(self.chunk_starts[k], end)
+
+    def steps(self, first=0, last=None):
+        '''
+            Iterates over the recorded steps.
+            Parameters:
+                first, last: the yielded timesteps are [first, last) (None: until the end)
+            Yields:
+                timestep, states, ids, remainings (read-only views)
+        '''
+        last = self.n_steps if last is None else last
+        for k in range(len(self.chunk_starts)):
+            steps = self.chunk_steps(k)
+            if (steps.stop <= first) or (steps.start >= last):
+                continue
+            offsets = self._load("offsets", k)
+            states, ids, remainings = self._load("states", k), self._load("ids", k), self._load("remainings", k)
+            for t in range(max(first, steps.start), min(last, steps.stop)):
+                rows = slice(offsets[t-steps.start], offsets[t-steps.start+1])
+                yield t, states[rows], ids[rows], remainings[rows]
+
+
+def replay(path, callback, first=0, last=None):
+    '''
+        Feeds a recorded trajectory to a simulator callback.
+        Parameters:
+            path: directory of the recorded trajectory
+            callback: callback(timestep, states, ids, remainings)
+            first, last: the replayed timesteps are [first, last) (None: until the end)
+        Returns:
+            the number of replayed steps
+    '''
+    n_steps = 0
+    for t, states, ids, remainings in Trajectory(path).steps(first, last):
+        callback(t, states, ids, remainings)
+        n_steps += 1
+    return n_steps
+
+
+
+def _replay_range(job):
+    path, make_callback, first, last = job
+    callback = make_callback()
+    replay(path, callback, first, last)
+    return callback
+
+
+def replay_parallel(path, make_callback, workers=None, n_parts=None):
+    '''
+        Replays a recorded trajectory in parallel over time ranges. Only for callbacks that
+        are stateless between steps (e.g. not MeasCallback): every range is fed to a new callback.
+        Parameters:
+            path: directory of the recorded trajectory
+            make_callback: picklable function creating a (picklable) callback
+            workers: number of worker processes (None: number of CPUs)
+            n_parts: number of time ranges (None: the number of workers)
+        Returns:
+            the callbacks of the time ranges, in order of time
+    '''
+    trajectory = Trajectory(path)
+    if len(trajectory.chunk_starts) == 0:
+        return []
+    n_parts = (workers or os.cpu_count()) if n_parts is None else n_parts
+    #the ranges consist of whole chunks, so every chunk is read by one worker:
+    n_parts = max(1, min(n_parts, len(trajectory.chunk_starts)))
+    parts = np.array_split(np.arange(len(trajectory.chunk_starts)), n_parts)
+    jobs = [(path, make_callback, trajectory.chunk_steps(part[0]).start, trajectory.chunk_steps(part[-1]).stop)
+            for part in parts]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_replay_range, jobs))
@@ -0,0 +1,100 @@
+'''Runs a sweep of measurements (configurations x mix_n sets) on a process pool.
+
+By default, the mix_n sets of a configuration are evaluated as policies of one simulation
+(see MeasCallback), so the simulation runs once per configuration.
+The precomputed artifacts (Markov chains, source probabilities, distances) are built once
+per network and turning definition into the artifact cache; the workers memory-map them,
+so they share the same pages. The results are written in the layout of meas_script_mix3.sh:
+    <result_root>/[random/]<level>/<symmetry>/mix<n values>/
+
+Example:
+    python3 sweep.py ../cfg/asymmetric_low.json ../cfg/symmetric_low.json -r ../results/ -n 1 2 3 12 13 23 123
+'''
+
+import os
+import json
+import time
+import argparse
+import concurrent.futures
+
+import measurement
+import tools.artifacts
+
+
+def result_dir(result_root, config_file, mix_n):
+    '''
+        Returns the result directory of a run, e.g. ../cfg/asymmetric_low_random.json, [1,2]
+        -> <result_root>/random/low/asymmetric/mix12/ (configuration files of other names
+        get <result_root>/<name>/mix12/)
+    '''
+    name = os.path.splitext(os.path.basename(config_file))[0]
+    parts = name.split("_")
+    mix = "mix" + "".join(str(n) for n in mix_n)
+    if (len(parts) in [2, 3]) and (parts[0] in ["symmetric", "asymmetric"]):
+        random = ["random"] if parts[2:] == ["random"] else []
+        return os.path.join(result_root, *random, parts[1], parts[0], mix) + os.sep
+    return os.path.join(result_root, name, mix) + os.sep
+
+
+def _run(job):
+    config_file, config, result_paths, mix_ns = job
+    for path in result_paths:
+        os.makedirs(path, exist_ok=True)
+    start = time.time()
+    measurement.run_measurement(config, result_paths, mix_ns, config_file)
+    return result_paths, time.time()-start
+
+
+def sweep(config_files, mix_ns, result_root, workers=None, cache_dir=None, single_pass=True):
+    '''
+        Runs every configuration with every mix_n set.
+        Parameters:
+            config_files: configuration json files
+            mix_ns: list of mix_n sets (e.g. [[1], [1,2], [1,2,3]])
+            result_root: root of the result directories
+            workers: number of worker processes (None: number of CPUs)
+            cache_dir: artifact cache directory of the configurations that do not set one
+                (None: <result_root>/.artifacts)
+            single_pass: if True, the mix_n sets of a configuration share one simulation,
+                otherwise every (configuration, mix_n) pair is simulated separately
+        Returns:
+            a result directory -> running time [s] map
+    '''
+    cache_dir = os.path.join(result_root, ".artifacts") if cache_dir is None else cache_dir
+    configs = {}
+    for config_file in config_files:
+        with open(config_file) as f:
+            configs[config_file] = json.load(f)
+        configs[config_file].setdefault("artifact_cache_dir", cache_dir)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        #building the artifacts once per network and turning definition:
+        unique = {tools.artifacts.config_key(config): config for config in configs.values()}
+        for path in pool.map(measurement.prepare_artifacts, unique.values()):
+            print("Artifacts are ready in {}".format(path))
+
+        groups = [mix_ns] if single_pass else [[mix_n] for mix_n in mix_ns]
+        jobs = [(config_file, config, [result_dir(result_root, config_file, mix_n) for mix_n in group], group)
+                for config_file, config in configs.items() for group in groups]
+        times = {}
+        for result_paths, run_time in pool.map(_run, jobs):
+            print("{} finished in {} seconds".format(", ".join(result_paths), run_time))
+            times.update({path: run_time for path in result_paths})
+    return times
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_files", type=str, nargs="+", help="configuration json files")
+    parser.add_argument("-r", "--result_root", type=str, default="../results/",
+                        help="root of the result directories")
+    parser.add_argument("-n", "--mix_n", nargs="+", default=["1", "2", "3", "12", "13", "23", "123"],
+                        help="mix_n sets, the digits of an item are the n values (e.g. 12 -> n = 1, 2)")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--cache_dir", type=str, default=None, help="artifact cache directory")
+    parser.add_argument("--separate", action="store_true",
+                        help="simulate every mix_n set separately (instead of one simulation per configuration)")
+
+    args = parser.parse_args()
+    mix_ns = [[int(n) for n in item] for item in args.mix_n]
+    sweep(args.config_files, mix_ns, args.result_root, args.workers, args.cache_dir, not(args.separate))
@@ -1,17 +1,22 @@
 ''' This module implements functions to decide the length of the shared route.'''
 
 import numpy as np
+import scipy.sparse as sp
 
 import metrics
 
-def tell_uniform(P, route):
+def tell_uniform(P, route, rng=None):
     ''' Selects a random length by sampling a uniform distribution.
         Parameters:
             P: _backward_ transition matrix of the Markov chain
-            route: the actual route of a vehicle'''
+            route: the actual route of a vehicle
+            rng: np.random.Generator (None: the global np.random state)'''
     assert len(route)>0
     
-    r = len(route) if len(route)<2 else np.random.randint(1, len(route), 1)[0]
+    if len(route)<2:
+        r = len(route)
+    else:
+        r = np.random.randint(1, len(route), 1)[0] if rng is None else rng.integers(1, len(route))
     return route[-r:]
 
 def tell_min_prob(P, route, o_dist, matrix_power, source_probs):
@@ -51,16 +56,111 @@ def tell_last_n(P, route, n):
         r += 1
     return route[-(r-1):]
 
-def tell_mix(P, route, st_dist, matrix_power, n, source_probs):
-    ''' Randomly selects a method from above ones.'''
+def tell_mix(P, route, st_dist, matrix_power, n, source_probs, rng=None):
+    ''' Randomly selects a method from above ones (rng: np.random.Generator, None: the global np.random state).'''
     assert len(route)>0
     
-    method = np.random.choice(np.arange(0, len(n)+2), 1)[0]
+    rng = np.random if rng is None else rng
+    method = rng.choice(np.arange(0, len(n)+2), 1)[0]
     answer = []
     if method == 0:
-        answer = tell_uniform(P, route)
+        answer = tell_uniform(P, route, None if rng is np.random else rng)
     elif method == 1:
         answer = tell_min_prob(P, route, st_dist, matrix_power, source_probs)
     else:
-        answer = tell_last_n(P, route, np.random.choice(n, 1)[0]+1)
-    return answer
\ No newline at end of file
+        answer = tell_last_n(P, route, rng.choice(n, 1)[0]+1)
+    return answer
+
+##########################################
+######### BATCHED TELL DECISIONS #########
+# The tell state of the routes is maintained by a MovementTracker.
+# The functions return the number of shared edges (from the end of the routes).
+
+def most_likely_predecessors(P):
+    ''' Returns the most likely previous edge of every edge.
+        Parameters:
+            P: _backward_ transition matrix of the Markov chain (dense or scipy.sparse)'''
+    if sp.issparse(P):
+        return np.asarray(P.argmax(axis=1)).ravel()
+    return np.argmax(P, axis=1)
+
+def tell_uniform_batch(lengths, rng):
+    ''' Vectorized tell_uniform, returns the shared lengths.
+        Parameters:
+            lengths: lengths of the routes
+            rng: np.random.Generator'''
+    lengths = np.asarray(lengths)
+    return np.where(lengths < 2, lengths, rng.integers(1, np.maximum(lengths, 2)))
+
+def _mix_choice(lengths, min_prob_lengths, last_n, n, rng):
+    ''' Draws the method of the MIX selection for every route.
+        Parameters:
+            lengths: lengths of the routes
+            min_prob_lengths: results of the min-prob method
+            last_n: function computing the last-n results for one n value per route
+            n: n values of the MIX method
+            rng: np.random.Generator'''
+    methods = rng.integers(0, len(n)+2, size=len(lengths))
+    uniform = tell_uniform_batch(lengths, rng)
+    last = last_n(rng.choice(n, size=len(lengths))+1)
+    return np.select([methods == 0, methods == 1], [uniform, min_prob_lengths], last)
+
+def tell_last_n_from_turns(lengths, nth_turns):
+    ''' Computes tell_last_n from the street changes of the routes, returns the shared lengths.
+        Parameters:
+            lengths: lengths of the routes
+            nth_turns: position of the n-th last street change of the routes (-1: less changes)'''
+    return np.where(nth_turns >= 0, lengths-nth_turns, np.where(lengths > 2, lengths-2, lengths))
+
+def tell_mix_tracked(tracker, ids, mix_n, rng, min_prob_lengths=None):
+    ''' Computes tell_mix from the tell state maintained by the movement tracker,
+        returns the shared lengths.
+        Parameters:
+            tracker: a MovementTracker object maintaining the tell state
+            ids: ids of the sender vehicles
+            mix_n: n values of the MIX method
+            rng: np.random.Generator
+            min_prob_lengths: already computed results of the min-prob method (optional)'''
+    lengths = tracker.lengths(ids)
+    if min_prob_lengths is None:
+        min_prob_lengths = tracker.min_prob_lengths(ids)
+    last_n = lambda n: tell_last_n_from_turns(lengths, tracker.nth_last_turns(ids, n))
+    return _mix_choice(lengths, min_prob_lengths, last_n, mix_n, rng)
+
+def tell_tracked(tracker, ids, mix_n, rng, mix_rng=None):
+    ''' Computes the shared lengths of every method from the tell state maintained
+        by the movement tracker (see MovementTracker).
+        Parameters:
+            tracker: a MovementTracker object maintaining the tell state
+            ids: ids of the sender vehicles
+            mix_n: n values of the MIX method
+            rng: np.random.Generator
+            mix_rng: np.random.Generator of the MIX method (None: rng)
+        Returns:
+            a method name -> shared lengths map'''
+    mix_rng = rng if mix_rng is None else mix_rng
+    lengths = tracker.lengths(ids)
+    last_n = lambda n: tell_last_n_from_turns(lengths, tracker.nth_last_turns(ids, n))
+    min_prob = tracker.min_prob_lengths(ids)
+    return {
+        "uniform": tell_uniform_batch(lengths, rng),
+        "minprob": min_prob,
+        "last1": last_n(1),
+        "last2": last_n(2),
+        "last3": last_n(3),
+        "mix": tell_mix_tracked(tracker, ids, mix_n, mix_rng, min_prob)
+    }
+
+def tell_batch(tracker, ids, mix_n, rng, mix_rng=None):
+    ''' Computes the shared segments of every method for many routes at once (see tell_tracked).
+        Parameters:
+            tracker: a MovementTracker object maintaining the tell state
+            ids: ids of the sender vehicles
+            mix_n: n values of the MIX method
+            rng: np.random.Generator
+            mix_rng: np.random.Generator of the MIX method (None: rng)
+        Returns:
+            a method name -> (starts, ends) map, the shared part of the route of ids[k] is
+            its edges [starts[k]:ends[k]] (see MovementTracker.segments)'''
+    ends = tracker.lengths(ids)
+    return {method: (ends-lengths, ends) for method, lengths in tell_tracked(tracker, ids, mix_n, rng, mix_rng).items()}
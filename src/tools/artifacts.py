@@ -0,0 +1,141 @@
+'''Persistent, content-addressed cache of the precomputed Markov chain artifacts.
+
+The artifacts (P, π, P_b, edge maps, matrix powers, source probabilities and the
+all-pairs distance table) only depend on the road network, the turning definitions
+and the path length model. They are stored as .npy files, so a warm run can
+memory-map them and parallel runs share the pages through the OS page cache.'''
+
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+import scipy.sparse as sp
+
+import metrics
+
+#increase it when the stored artifacts change:
+CACHE_VERSION = 2
+
+
+def config_key(config):
+    '''
+        Computes the cache key of a measurement configuration.
+        Parameters:
+            config: measurement configuration (as loaded from the json file)
+        Returns:
+            a hex digest of the contents of the network and turning files, the default
+            turning definition and the path length model
+    '''
+    digest = hashlib.sha256()
+    digest.update(str(CACHE_VERSION).encode())
+    for path in [config["sumo_grid"], config["specific_turning_definition"]]:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(2**20), b""):
+                digest.update(block)
+    digest.update(json.dumps(config["default_turning_definition"]).encode())
+    digest.update(json.dumps(config["feeding_model"]["path_length_model"]).encode())
+    return digest.hexdigest()
+
+
+class ArtifactCache:
+    '''Directory of artifacts belonging to one configuration key.'''
+    def __init__(self, cache_dir, config):
+        ''' Parameters:
+            cache_dir: root directory of the cache
+            config: measurement configuration'''
+        self.key = config_key(config)
+        self.path = os.path.join(cache_dir, self.key)
+        os.makedirs(self.path, exist_ok=True)
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _atomic_write(self, name, write):
+        #writing into a temporary file first, so concurrent runs never see partial files:
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, self._file(name))
+
+    def is_complete(self):
+        return os.path.exists(self._file("meta.json"))
+
+    def save_array(self, name, array):
+        self._atomic_write(name+".npy", lambda f: np.save(f, np.asarray(array)))
+
+    def load_array(self, name):
+        return np.load(self._file(name+".npy"), mmap_mode="r")
+
+    def has_array(self, name):
+        return os.path.exists(self._file(name+".npy"))
+
+    def save_sparse(self, name, matrix):
+        matrix = sp.csr_matrix(matrix)
+        self.save_array(name+"_data", matrix.data)
+        self.save_array(name+"_indices", matrix.indices)
+        self.save_array(name+"_indptr", matrix.indptr)
+
+    def load_sparse(self, name, shape):
+        return sp.csr_matrix((self.load_array(name+"_data"),
+                              self.load_array(name+"_indices"),
+                              self.load_array(name+"_indptr")), shape=shape)
+
+    def save_json(self, name, data):
+        self._atomic_write(name+".json", lambda f: f.write(json.dumps(data).encode()))
+
+    def load_json(self, name):
+        with open(self._file(name+".json")) as f:
+            return json.load(f)
+
+
+def save_chain_artifacts(cache, P, π, P_b, index_to_edge_map, source_probs, distance_calculator):
+    '''
+        Stores the precomputed artifacts of a configuration.
+        Parameters:
+            cache: an ArtifactCache object
+            P: forward transition matrix (dense or sparse)
+            π: stationary distribution
+            P_b: backward transition matrix (dense or sparse)
+            index_to_edge_map: indices of P -> network edges
+            source_probs: a metrics.SourceProbabilities object (its power tensor is
+                only stored if it has one)
+            distance_calculator: a metrics.DistanceCalculator object
+    '''
+    cache.save_sparse("P", P)
+    cache.save_array("stationary", π)
+    cache.save_sparse("P_b", P_b)
+    if not(source_probs.power_tensor is None):
+        cache.save_array("power_tensor", source_probs.power_tensor)
+    cache.save_array("alter_sources", source_probs.alter_sources)
+    cache.save_array("distances", distance_calculator.to_array())
+    #meta.json is written last, it marks the cache complete:
+    cache.save_json("meta", {"version": CACHE_VERSION,
+                             "n_edges": len(π),
+                             "index_to_edge": [index_to_edge_map[i] for i in range(len(index_to_edge_map))]})
+
+
+def load_chain_artifacts(cache, sparse=False):
+    '''
+        Loads the precomputed artifacts of a configuration (large arrays are memory-mapped).
+        Parameters:
+            cache: a complete ArtifactCache object
+            sparse: if False, P and P_b are returned as dense arrays
+        Returns:
+            P, π, P_b, edge_to_index_map, index_to_edge_map, source_probs, distance_calculator
+            (the power tensor of source_probs is None if it is not stored)
+    '''
+    meta = cache.load_json("meta")
+    shape = (meta["n_edges"], meta["n_edges"])
+    index_to_edge_map = dict(enumerate(meta["index_to_edge"]))
+    edge_to_index_map = {edge: i for i, edge in index_to_edge_map.items()}
+    P = cache.load_sparse("P", shape)
+    P_b = cache.load_sparse("P_b", shape)
+    if not sparse:
+        P, P_b = P.toarray(), P_b.toarray()
+    π = np.array(cache.load_array("stationary"))
+    power_tensor = cache.load_array("power_tensor") if cache.has_array("power_tensor") else None
+    source_probs = metrics.SourceProbabilities.from_arrays(power_tensor, cache.load_array("alter_sources"))
+    distance_calculator = metrics.DistanceCalculator.from_array(cache.load_array("distances"))
+    return P, π, P_b, edge_to_index_map, index_to_edge_map, source_probs, distance_calculator
@@ -1,19 +1,24 @@
 '''Methods to handle SUMO networks as Markov Chains (MCs)'''
 
+import inspect
+
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
 from sklearn.preprocessing import normalize
 
 import sumolib
 
 ##############################################################
 ################ METHODS FOR PREPROCESSING ###################
-def read_MC(network_path: str, turning_path: str, default_turning_rates: list):
+def read_MC(network_path: str, turning_path: str, default_turning_rates: list, sparse=False):
     '''
         Reads a SUMO network and the turning description file. Then converts them into a MC.
         Parameters:
             network_path: path to the SUMO road network file
             turning_path: path to the turning definition file
+            sparse: if True, P is returned as a scipy.sparse CSR matrix
         Return:
             P: transition matrix of the MC
             edge_to_index_map: network edges -> indices of P
@@ -22,7 +27,7 @@ def read_MC(network_path: str, turning_path: str, default_turning_rates: list):
     
     net = sumolib.net.readNet(network_path)
     turning_desc = pd.read_xml(turning_path, xpath="./interval/*")
-    return create_transition_matrix(net, default_turning_rates, turning_desc)
+    return create_transition_matrix(net, default_turning_rates, turning_desc, sparse)
 
 
 def get_turn_probabilities(from_edge, turning_rates, special_turning_rates=None):
@@ -69,7 +74,7 @@ def get_turn_probabilities(from_edge, turning_rates, special_turning_rates=None)
             turn_idx += 1
     return answer
 
-def create_transition_matrix(net, turning_rates, special_turning_rates):
+def create_transition_matrix(net, turning_rates, special_turning_rates, sparse=False):
     """
         Creates the MCtransition matrix from a SUMO network,
         given the turning rates, and special turning rates.
@@ -78,13 +83,15 @@ def create_transition_matrix(net, turning_rates, special_turning_rates):
             net: a SUMO road network object
             turning_rates: list defining the default turning rates
             special_turning_rates: definition of special turning rates
+            sparse: if True, the transition matrix is built as a CSR matrix,
+                so its memory grows with the number of connections only
     
         Returns the transition matrix, the dictionary of edge indices to the
         coordinates of P, and also its inverse."""
     
     edge_to_index_map = {}
     index_to_edge_map = {}
-    P = np.zeros([len(net._edges), len(net._edges)])
+    transitions = {} #(from, to) -> probability, later connections overwrite the earlier ones
     
     for edge in net.getEdges():
         probs = get_turn_probabilities(edge, turning_rates, special_turning_rates)
@@ -96,16 +103,24 @@ def create_transition_matrix(net, turning_rates, special_turning_rates):
             if not(to_edge._id) in edge_to_index_map:
                 edge_to_index_map[to_edge._id] = len(edge_to_index_map)
                 index_to_edge_map[len(index_to_edge_map)] = to_edge._id
-            P[edge_to_index_map[edge._id], edge_to_index_map[to_edge._id]] = probs[conn]
+            transitions[(edge_to_index_map[edge._id], edge_to_index_map[to_edge._id])] = probs[conn]
+
+    n_edges = len(net._edges)
+    rows = np.fromiter((ij[0] for ij in transitions), dtype=np.int64, count=len(transitions))
+    cols = np.fromiter((ij[1] for ij in transitions), dtype=np.int64, count=len(transitions))
+    probabilities = np.fromiter(transitions.values(), dtype=float, count=len(transitions))
+    if sparse:
+        P = sp.csr_matrix((probabilities, (rows, cols)), shape=(n_edges, n_edges))
+    else:
+        P = np.zeros([n_edges, n_edges])
+        P[rows, cols] = probabilities
     return P, edge_to_index_map, index_to_edge_map
 
 def list_terminating_edges(trans_mtx):
         #an edge is a terminating edge, iff no edges go out from that
-        terminating_edges = []
-        for i in range(len(trans_mtx)):
-            if np.sum(trans_mtx[i, :]) == 0:
-                terminating_edges.append(i)
-        return terminating_edges
+        #(works on both dense and sparse transition matrices)
+        out_probabilities = np.asarray(trans_mtx.sum(axis=1)).ravel()
+        return np.flatnonzero(out_probabilities == 0).tolist()
 
 # Methods for creating an irreducible, positive MC
 # Construction:
@@ -168,10 +183,36 @@ def add_st_node(P, source_distribution=None):
 #########################################
 ####### STATIONARY DISTRIBUTION #########
 
-def calculate_stationary_distribution(P):
-    P2 = P.T - np.eye(len(P))
-    P2[-1] = np.ones(len(P))
-    return np.linalg.solve(P2, np.concatenate((np.zeros(len(P2)-1), [1])))
+#older scipy versions call the relative tolerance of the iterative solvers `tol`:
+_GMRES_TOL_KEYWORD = "rtol" if "rtol" in inspect.signature(spla.gmres).parameters else "tol"
+
+def calculate_stationary_distribution(P, tol=1e-12, maxiter=None):
+    '''
+        Solves π = πP, sum(π) = 1. The last equation of (P^T - I)π = 0 is replaced by
+        the normalization constraint.
+        Parameters:
+            P: transition matrix of the MC (dense or scipy.sparse)
+            tol: relative tolerance of the iterative solver (sparse P only)
+            maxiter: iteration limit of the iterative solver (sparse P only)
+        For a sparse P, the system is solved iteratively (GMRES); if that does not
+        converge, a sparse LU factorization is used instead.
+    '''
+    if not sp.issparse(P):
+        P2 = P.T - np.eye(len(P))
+        P2[-1] = np.ones(len(P))
+        return np.linalg.solve(P2, np.concatenate((np.zeros(len(P2)-1), [1])))
+
+    n = P.shape[0]
+    P2 = (P.T - sp.identity(n, format="csr")).tocsr()[:-1]
+    P2 = sp.vstack((P2, sp.csr_matrix(np.ones((1, n))))).tocsr()
+    b = np.zeros(n)
+    b[-1] = 1.0
+    tolerance = {_GMRES_TOL_KEYWORD: tol}
+    π, info = spla.gmres(P2, b, x0=np.full(n, 1/n), atol=0.0,
+                         restart=min(n, 100), maxiter=maxiter, **tolerance)
+    if info != 0:
+        π = spla.spsolve(P2.tocsc(), b)
+    return π
 
 
 #########################################
@@ -182,7 +223,12 @@ def calculate_time_reversed_mc(P, π):
         Parameters:
             P: defines the transition matrix of the MC
             pi: defines the stationary distribution of the MC
+        If P is sparse, the result is a sparse CSR matrix as well.
     '''
+    if sp.issparse(P):
+        #scaling the rows of P^T without creating the dense Π matrix:
+        P_inv = sp.csr_matrix(P.T).multiply(np.asarray(π).reshape(-1, 1)).tocsr()
+        return normalize(P_inv, "l1")
     Π = np.tile(π, (len(π), 1)).T #a matrix filled with pi
     P_inv = P.T * Π #simply calculating the reversed version
     P_inv = normalize(P_inv, "l1")
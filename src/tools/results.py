@@ -0,0 +1,133 @@
+'''Binary, columnar result format of the measurement runs.
+
+A run directory contains
+- meta.json: format version, run metadata (configuration, mix_n, ...) and the stored chunks,
+- iong.npz: the IONG table, one array per column,
+- distances_<k>.npz: chunks of the distance records, one array per method and column
+  (stored under the "<method>.<column>" key).
+The .npz files are compressed and typed; their arrays are only read when accessed, so
+runs can be opened lazily and filtered by column and method.'''
+
+import os
+import glob
+import json
+import tempfile
+
+import numpy as np
+
+#increase it when the stored format changes:
+FORMAT_VERSION = 1
+DISTANCE_COLUMNS = ["ids", "times", "distances", "distance_diffs"]
+
+
+def _atomic_savez(path, name, arrays):
+    #writing into a temporary file first, so readers never see partial files:
+    fd, tmp_path = tempfile.mkstemp(dir=path, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp_path, os.path.join(path, name))
+
+
+def save_distance_chunk(path, index, chunk, method_names):
+    '''
+        Stores a chunk of distance records.
+        Parameters:
+            path: run directory
+            index: index of the chunk
+            chunk: column name -> array map, the method column contains indices of method_names
+            method_names: names of the telling methods
+    '''
+    arrays = {}
+    for i, method in enumerate(method_names):
+        selected = chunk["methods"] == i
+        for column in DISTANCE_COLUMNS:
+            arrays["%s.%s"%(method, column)] = chunk[column][selected]
+    _atomic_savez(path, "distances_%05d.npz"%index, arrays)
+
+
+def save_iong(path, iongs):
+    '''
+        Stores the IONG table.
+        Parameters:
+            path: run directory
+            iongs: pandas DataFrame of the IONG values (see tools.utils.create_iongs_dataframe)
+    '''
+    _atomic_savez(path, "iong.npz", {column: iongs[column].to_numpy() for column in iongs.columns})
+
+
+def save_meta(path, metadata, n_chunks, method_names):
+    '''
+        Stores the metadata of a run. It is written last, it marks the run complete.
+        Parameters:
+            path: run directory
+            metadata: json serializable run metadata (e.g. configuration, mix_n)
+            n_chunks: number of stored distance chunks
+            method_names: names of the telling methods
+    '''
+    meta = {"version": FORMAT_VERSION, "n_chunks": n_chunks, "methods": list(method_names),
+            "metadata": metadata}
+    fd, tmp_path = tempfile.mkstemp(dir=path, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(path, "meta.json"))
+
+
+class RunResults:
+    '''Lazily loaded results of one run: only meta.json is read when it is opened.'''
+    def __init__(self, path):
+        ''' Parameters:
+            path: run directory'''
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        assert meta["version"] == FORMAT_VERSION, "unsupported result format version %s"%meta["version"]
+        self.methods = meta["methods"]
+        self.n_chunks = meta["n_chunks"]
+        self.metadata = meta["metadata"]
+
+    def distances(self, columns=DISTANCE_COLUMNS, methods=None):
+        '''
+            Loads distance records.
+            Parameters:
+                columns: names of the loaded columns (see DISTANCE_COLUMNS)
+                methods: names of the loaded methods (None: all)
+            Returns:
+                a method -> (column -> array) map
+        '''
+        methods = self.methods if methods is None else methods
+        parts = {method: {column: [] for column in columns} for method in methods}
+        for index in range(self.n_chunks):
+            with np.load(os.path.join(self.path, "distances_%05d.npz"%index)) as chunk:
+                for method in methods:
+                    for column in columns:
+                        parts[method][column].append(chunk["%s.%s"%(method, column)])
+        return {method: {column: np.concatenate(values) if len(values) > 0 else np.array([])
+                         for column, values in columns_.items()}
+                for method, columns_ in parts.items()}
+
+    def iong(self, methods=None):
+        '''
+            Loads the IONG values.
+            Parameters:
+                methods: names of the loaded methods (None: all), ids are always loaded
+            Returns:
+                a column -> array map
+        '''
+        methods = self.methods if methods is None else methods
+        with np.load(os.path.join(self.path, "iong.npz")) as iongs:
+            return {column: iongs[column] for column in ["id"] + list(methods)}
+
+
+def load_runs(result_dir):
+    '''
+        Opens every (binary) run found under a directory lazily.
+        Parameters:
+            result_dir: root directory of the results (e.g. ../results/)
+        Returns:
+            a run directory (relative to result_dir) -> RunResults map
+    '''
+    runs = {}
+    for meta_path in sorted(glob.glob(os.path.join(result_dir, "**", "meta.json"), recursive=True)):
+        path = os.path.dirname(meta_path)
+        runs[os.path.relpath(path, result_dir)] = RunResults(path)
+    return runs
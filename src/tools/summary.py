@@ -0,0 +1,197 @@
+'''Online summary statistics of the privacy and IONG metrics.
+
+The statistics are updated in batches during the simulation and use bounded memory,
+so they can replace the raw records of long and dense runs:
+- running moments (count, mean, variance, min, max),
+- quantile sketches with a relative accuracy guarantee (DDSketch-like log buckets),
+- histograms with fixed bins.'''
+
+import json
+import math
+import collections
+
+import numpy as np
+
+QUANTILES = [0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99]
+DEFAULT_BINS = np.arange(-2000, 5001, 100)
+
+
+class RunningMoments:
+    '''Count, mean, variance, min and max of a stream of values (batched Welford updates).'''
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return
+        count = self.count + len(values)
+        batch_mean = values.mean()
+        delta = batch_mean - self.mean
+        self.m2 += ((values-batch_mean)**2).sum() + delta**2 * self.count*len(values)/count
+        self.mean += delta * len(values)/count
+        self.count = count
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+    def to_dict(self):
+        return {"count": self.count, "mean": self.mean,
+                "std": math.sqrt(self.m2/self.count) if self.count > 0 else None,
+                "min": self.min if self.count > 0 else None,
+                "max": self.max if self.count > 0 else None}
+
+
+class QuantileSketch:
+    '''
+        Quantile sketch with logarithmic buckets: every returned quantile is within
+        alpha relative error of a true sample value. The number of buckets only
+        grows with the logarithm of the value range.
+    '''
+    def __init__(self, alpha=0.01, min_value=1e-3):
+        ''' Parameters:
+            alpha: relative accuracy
+            min_value: values with smaller absolute value are counted as zeros'''
+        self.gamma = (1+alpha)/(1-alpha)
+        self.log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        self.positive = collections.Counter()
+        self.negative = collections.Counter()
+        self.zeros = 0
+        self.count = 0
+
+    @staticmethod
+    def _update(store, keys):
+        keys, counts = np.unique(keys, return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            store[key] += count
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        self.count += len(values)
+        magnitudes = np.abs(values)
+        large = magnitudes >= self.min_value
+        self.zeros += int(np.count_nonzero(~large))
+        keys = np.ceil(np.log(magnitudes[large])/self.log_gamma).astype(np.int64)
+        self._update(self.positive, keys[values[large] > 0])
+        self._update(self.negative, keys[values[large] < 0])
+
+    def _value(self, key):
+        return 2*self.gamma**key/(self.gamma+1)
+
+    def quantile(self, q):
+        ''' Returns the approximate q-quantile (None if the sketch is empty).'''
+        if self.count == 0:
+            return None
+        rank = q*(self.count-1)
+        seen = 0
+        #in increasing order of the values:
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self._value(key)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self._value(key)
+        return self._value(max(self.positive))
+
+
+class Histogram:
+    '''Histogram with fixed bins, values outside of the bins are counted separately.'''
+    def __init__(self, bins=DEFAULT_BINS):
+        self.bins = np.asarray(bins, dtype=np.float64)
+        self.counts = np.zeros(len(self.bins)-1, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        self.underflow += int(np.count_nonzero(values < self.bins[0]))
+        self.overflow += int(np.count_nonzero(values > self.bins[-1]))
+        self.counts += np.histogram(values, self.bins)[0]
+
+    def to_dict(self):
+        return {"bins": self.bins.tolist(), "counts": self.counts.tolist(),
+                "underflow": self.underflow, "overflow": self.overflow}
+
+
+class MetricSummary:
+    '''Moments, quantile sketch and histogram of one metric.'''
+    def __init__(self, bins=DEFAULT_BINS, alpha=0.01):
+        self.moments = RunningMoments()
+        self.sketch = QuantileSketch(alpha)
+        self.histogram = Histogram(bins)
+
+    def add(self, values):
+        self.moments.add(values)
+        self.sketch.add(values)
+        self.histogram.add(values)
+
+    def to_dict(self):
+        answer = self.moments.to_dict()
+        answer["quantiles"] = {str(q): self.sketch.quantile(q) for q in QUANTILES}
+        answer["histogram"] = self.histogram.to_dict()
+        return answer
+
+
+class RunSummary:
+    '''Per-method summaries of the "Alter correctness", "Distance difference" and IONG metrics.'''
+    def __init__(self, method_names, bins=DEFAULT_BINS, iong_bins=None, alpha=0.01):
+        '''
+            Parameters:
+                method_names: names of the telling methods
+                bins: histogram bins of the distance metrics [m]
+                iong_bins: histogram bins of IONG (None: 0, 1, ..., 200)
+                alpha: relative accuracy of the quantiles
+        '''
+        iong_bins = np.arange(0, 201) if iong_bins is None else iong_bins
+        self.method_names = list(method_names)
+        self.correctness = {method: MetricSummary(bins, alpha) for method in self.method_names}
+        self.differences = {method: MetricSummary(bins, alpha) for method in self.method_names}
+        self.iong = {method: MetricSummary(iong_bins, alpha) for method in self.method_names}
+        #number of vehicles that did not receive any information:
+        self.no_information = 0
+
+    def add_distances(self, methods, distances, dist_differences):
+        '''
+            Parameters:
+                methods: method indices of the records (in method_names)
+                distances: "Alter correctness" values of the records
+                dist_differences: "Distance difference" values of the records
+        '''
+        methods = np.asarray(methods)
+        for i, method in enumerate(self.method_names):
+            selected = methods == i
+            if np.any(selected):
+                self.correctness[method].add(np.asarray(distances)[selected])
+                self.differences[method].add(np.asarray(dist_differences)[selected])
+
+    def add_iong(self, iongs):
+        '''
+            Parameters:
+                iongs: (methods, vehicles) array of IONG values, -1 for vehicles without information
+        '''
+        received = iongs[0] >= 0
+        self.no_information += int(np.count_nonzero(~received))
+        for i, method in enumerate(self.method_names):
+            self.iong[method].add(iongs[i, received])
+
+    def to_dict(self):
+        return {"Alter correctness": {method: s.to_dict() for method, s in self.correctness.items()},
+                "Distance difference": {method: s.to_dict() for method, s in self.differences.items()},
+                "IONG": {method: s.to_dict() for method, s in self.iong.items()},
+                "vehicles without information": self.no_information}
+
+    def save(self, filename, metadata=None):
+        ''' Writes the summary as a json file (with optional run metadata).'''
+        summary = self.to_dict()
+        summary["metadata"] = metadata
+        with open(filename, "w") as f:
+            json.dump(summary, f)
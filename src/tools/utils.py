@@ -4,9 +4,12 @@
 import time
 import json
 import math
+import collections
+import tempfile
 
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 
 import matplotlib.colors
 import matplotlib.cm as cmx
@@ -15,6 +18,7 @@ import matplotlib.pyplot as plt
 import sumolib
 from sumolib.visualization import helpers
 import tools.mc as mc
+import tools.results as results
 
 import io
 import imageio
@@ -22,7 +26,6 @@ import imageio
 import os
 import sys
 sys.path.append("../")
-import metrics
 
 import torch
 
@@ -110,108 +113,279 @@ class MatrixPower:
     '''
         Provides fast calculation of matrix power by storing
         previous results in the memory.
+        Indexing: self(n) returns base_matrix^(n+1), i.e. self(0) is the base matrix itself.
+        Every instance has its own LRU cache. If memory_budget is given, the least recently
+        used powers are evicted (or spilled into memory-mapped .npy files in a temporary
+        directory under spill_dir, which is removed by close()).
     '''
-    powers = {}
-    def __init__(self, base_matrix, max_n=40):
-        self.base_matrix = np.array(base_matrix)
-        self.powers[0] = base_matrix
+    def __init__(self, base_matrix, max_n=40, memory_budget=None, spill_dir=None):
+        ''' Parameters:
+            base_matrix: the matrix to be powered (dense or scipy.sparse, the powers are dense)
+            max_n: number of powers to precompute
+            memory_budget: maximal number of bytes kept in memory (None: unlimited)
+            spill_dir: evicted powers are saved into this directory (None: evicted powers are dropped)'''
+        self.base_matrix = base_matrix.toarray() if sp.issparse(base_matrix) else np.array(base_matrix)
+        self.memory_budget = memory_budget
+        #the temporary directory is also removed when the object is garbage collected:
+        self._spill_dir = (None if spill_dir is None
+                           else tempfile.TemporaryDirectory(prefix="matrix_power_", dir=spill_dir))
+        self.spill_dir = None if self._spill_dir is None else self._spill_dir.name
+        self.powers = collections.OrderedDict() #n -> power, from the least to the most recently used
+        self.spilled = {} #n -> path of the spilled power
+        self.mapped = {} #n -> memory-mapped power (not counted in the memory budget)
+        self.stored_bytes = 0
+        self.stats = {"hits": 0, "spill_hits": 0, "misses": 0, "evictions": 0, "spills": 0}
+        self._store(0, self.base_matrix)
         #for faster calculation on GPU:
         if torch.cuda.is_available():
-            base = torch.from_numpy(base_matrix).to("cuda")
-            y = torch.from_numpy(base_matrix).to("cuda")
+            base = torch.from_numpy(self.base_matrix).to("cuda")
+            y = torch.from_numpy(self.base_matrix).to("cuda")
             with torch.no_grad():
                 for i in range(1, max_n):
                     y = y @ base
-                    self.powers[i] = y.to("cpu").numpy()
+                    self._store(i, y.to("cpu").numpy())
         else:
+            y = self.base_matrix
             for i in range(1, max_n):
-                self.powers[i] = self.powers[i-1] @ base_matrix
-        
+                y = y @ self.base_matrix
+                self._store(i, y)
+
+    @classmethod
+    def from_powers(cls, base_matrix, powers, memory_budget=None, spill_dir=None):
+        ''' Creates the object from previously calculated powers (powers[n] = base_matrix^(n+1)),
+            e.g. from a memory-mapped power tensor. Memory-mapped powers are used in place,
+            they are not counted in the memory budget.'''
+        matrix_power = cls(base_matrix, max_n=1, memory_budget=memory_budget, spill_dir=spill_dir)
+        for n in range(1, len(powers)):
+            if isinstance(powers[n], np.memmap):
+                matrix_power.mapped[n] = powers[n]
+            else:
+                matrix_power._store(n, powers[n])
+        return matrix_power
+
+    def close(self):
+        ''' Removes the spilled powers.'''
+        self.spilled = {}
+        if not(self._spill_dir is None):
+            self._spill_dir.cleanup()
+
+    def _store(self, n, power):
+        self.powers[n] = power
+        self.stored_bytes += power.nbytes
+        #evicting the least recently used powers, but never the newest one:
+        while (not(self.memory_budget is None) and (self.stored_bytes > self.memory_budget)
+               and (len(self.powers) > 1)):
+            evicted_n, evicted = self.powers.popitem(last=False)
+            self.stored_bytes -= evicted.nbytes
+            self.stats["evictions"] += 1
+            if not(self.spill_dir is None) and not(evicted_n in self.spilled):
+                path = os.path.join(self.spill_dir, "power_%d.npy"%evicted_n)
+                np.save(path, evicted)
+                self.spilled[evicted_n] = path
+                self.stats["spills"] += 1
+
+    def _lookup(self, n):
+        if n in self.powers:
+            self.powers.move_to_end(n)
+            return self.powers[n]
+        if n in self.mapped:
+            return self.mapped[n]
+        if n in self.spilled:
+            return np.load(self.spilled[n], mmap_mode="r")
+        return None
+
+    def _compute(self, n):
+        #starting from the nearest cached power below n (exponents are n+1):
+        cached = [k for k in list(self.powers)+list(self.mapped)+list(self.spilled) if k < n]
+        if len(cached) == 0:
+            return np.linalg.matrix_power(self.base_matrix, n+1)
+        k = max(cached)
+        remainder = n-k-1 #base^(n+1) = base^(k+1) @ base^(n-k)
+        remainder_power = self._lookup(remainder)
+        if remainder_power is None:
+            #repeated squaring of the base matrix:
+            remainder_power = np.linalg.matrix_power(self.base_matrix, remainder+1)
+        return self._lookup(k) @ remainder_power
+
     def __call__(self, n):
-        if not(n in self.powers):
-            self.powers[n] = np.linalg.matrix_power(self.base_matrix, n)
-        return self.powers[n]
+        if (n in self.powers) or (n in self.mapped):
+            self.stats["hits"] += 1
+        elif n in self.spilled:
+            self.stats["spill_hits"] += 1
+        else:
+            self.stats["misses"] += 1
+            self._store(n, self._compute(n))
+        return self._lookup(n)
+
+    def row(self, edge, n):
+        ''' Returns row edge of self(n).'''
+        return self(n)[edge]
+
+    def entries(self, rows, ns, cols):
+        ''' Returns self(ns[i])[rows[i], cols[i]] for every i (every power is looked up once).'''
+        rows, ns, cols = [np.asarray(a, dtype=np.int64) for a in (rows, ns, cols)]
+        answer = np.empty(len(rows))
+        for n in np.unique(ns):
+            now = np.flatnonzero(ns == n)
+            answer[now] = self(n)[rows[now], cols[now]]
+        return answer
+
+    def cache_info(self):
+        ''' Returns the cache counters together with the actual memory usage.'''
+        info = dict(self.stats)
+        info["stored_bytes"] = self.stored_bytes
+        info["stored_powers"] = len(self.powers)
+        info["spilled_powers"] = len(self.spilled)
+        info["mapped_powers"] = len(self.mapped)
+        return info
+
+
+class VectorPropagation:
+    '''
+        Computes rows of matrix powers (i.e. t_r @ P^k distributions) by repeated
+        sparse vector-matrix products, so no N x N power is ever formed.
+        Indexing follows MatrixPower: the d-th element belongs to MatrixPower(P)(d).
+    '''
+    def __init__(self, base_matrix, max_n=40, batch_size=256):
+        ''' Parameters:
+            base_matrix: the matrix to be powered (dense or scipy.sparse)
+            max_n: number of powers to propagate
+            batch_size: number of start vectors propagated together'''
+        self.base_matrix = sp.csr_matrix(base_matrix)
+        #propagating column vectors with the transposed matrix keeps the products CSR x dense:
+        self.base_matrix_T = self.base_matrix.T.tocsr()
+        self.max_n = max_n
+        self.batch_size = batch_size
+
+    def propagate(self, start_vectors, max_n=None):
+        '''
+            Propagates the rows of start_vectors through the powers of the base matrix.
+            Parameters:
+                start_vectors: (k, N) array of row vectors
+                max_n: number of powers to propagate (defaults to self.max_n)
+            Returns:
+                (max_n, k, N) array, answer[d] = start_vectors @ MatrixPower(P)(d)
+        '''
+        max_n = self.max_n if max_n is None else max_n
+        x = np.asarray(start_vectors, dtype=float).T
+        answer = np.empty((max_n, x.shape[1], x.shape[0]))
+        for d in range(max_n):
+            x = self.base_matrix_T @ x
+            answer[d] = x.T
+        return answer
+
+    def propagate_edges(self, edges, max_n=None):
+        ''' Same as propagate, for one-hot start vectors of the given edge indices.'''
+        start_vectors = np.zeros((len(edges), self.base_matrix.shape[0]))
+        start_vectors[np.arange(len(edges)), edges] = 1.0
+        return self.propagate(start_vectors, max_n)
+
+    def edge_batches(self, max_n=None):
+        ''' Iterates through all edges in batches, yielding (edges, propagate_edges(edges)).'''
+        n_edges = self.base_matrix.shape[0]
+        for first in range(0, n_edges, self.batch_size):
+            edges = np.arange(first, min(first+self.batch_size, n_edges))
+            yield edges, self.propagate_edges(edges, max_n)
+
+    def row(self, edge, n):
+        ''' Returns row edge of MatrixPower(P)(n).'''
+        return self.propagate_edges([edge], n+1)[n, 0]
+
+    def entries(self, rows, ns, cols):
+        '''
+            Returns MatrixPower(P)(ns[i])[rows[i], cols[i]] for every i. Only the distinct rows
+            are propagated (in batches), each batch only as far as its largest n.
+        '''
+        rows, ns, cols = [np.asarray(a, dtype=np.int64) for a in (rows, ns, cols)]
+        answer = np.empty(len(rows))
+        if len(rows) == 0:
+            return answer
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        max_ns = np.zeros(len(unique_rows), dtype=np.int64)
+        np.maximum.at(max_ns, inverse, ns)
+        #rows needing similar depths are propagated together:
+        order = np.argsort(max_ns, kind="stable")
+        batch_of = np.empty(len(unique_rows), dtype=np.int64)
+        batch_of[order] = np.arange(len(unique_rows)) // self.batch_size
+        column_of = np.empty(len(unique_rows), dtype=np.int64)
+        column_of[order] = np.arange(len(unique_rows)) % self.batch_size
+        for b, first in enumerate(range(0, len(unique_rows), self.batch_size)):
+            batch_rows = unique_rows[order[first:first+self.batch_size]]
+            x = np.zeros((self.base_matrix.shape[0], len(batch_rows)))
+            x[batch_rows, np.arange(len(batch_rows))] = 1.0
+            in_batch = np.flatnonzero(batch_of[inverse] == b)
+            for d in range(ns[in_batch].max()+1):
+                x = self.base_matrix_T @ x
+                now = in_batch[ns[in_batch] == d]
+                answer[now] = x[cols[now], column_of[inverse[now]]]
+        return answer
 
 
 ##########################################
 ############ OTHER HELPERS ###############
-def create_iongs_dataframe(measurement_tool):
-    iongs_uniform = []
-    iongs_minprob = []
-    iongs_last1 = []
-    iongs_last2 = []
-    iongs_last3 = []
-    iongs_mix = []
-    ids = []
-
-    for _id in measurement_tool.movement_tracker.movements:
-        ids.append(_id)
-        #if a vehicle received information, it gathered additional information:
-        if _id in measurement_tool.received_information_uniform:
-            iongs_uniform.append(metrics.compute_iong(measurement_tool.movement_tracker.movements[_id],
-                                         measurement_tool.received_information_uniform[_id]))
-            iongs_minprob.append(metrics.compute_iong(measurement_tool.movement_tracker.movements[_id],
-                                         measurement_tool.received_information_minprob[_id]))
-            iongs_last1.append(metrics.compute_iong(measurement_tool.movement_tracker.movements[_id],
-                                         measurement_tool.received_information_last1[_id]))
-            iongs_last2.append(metrics.compute_iong(measurement_tool.movement_tracker.movements[_id],
-                                         measurement_tool.received_information_last2[_id]))
-            iongs_last3.append(metrics.compute_iong(measurement_tool.movement_tracker.movements[_id],
-                                         measurement_tool.received_information_last3[_id]))
-            iongs_mix.append(metrics.compute_iong(measurement_tool.movement_tracker.movements[_id],
-                                         measurement_tool.received_information_mix[_id]))
-
-        else:
-            #otherwise, it did not:
-            iongs_uniform.append(-1)
-            iongs_minprob.append(-1)
-            iongs_last1.append(-1)
-            iongs_last2.append(-1)
-            iongs_last3.append(-1)
-            iongs_mix.append(-1)
-    
-    answer = pd.DataFrame(np.array([ids, iongs_uniform, iongs_minprob, iongs_last1, iongs_last2, iongs_last3, iongs_mix]).T,
+def create_iongs_dataframe(measurement_tool, policy=0):
+    #vehicles that did not receive information have -1 values:
+    ids, iongs = measurement_tool.iong_table(policy)
+    answer = pd.DataFrame(np.vstack([ids, iongs]).T,
                          columns = ["id", "uniform", "minprob", "last1", "last2", "last3", "mix"])
     return answer
 
-def create_distance_data(measurement_tool, filename):
-    #records = measurement_tool.distance_records
-    #data = np.array([records.method, records.ids, records.times, records.distances, records.distance_diffs]).T
-    #minimizing memory usage:
-    #distances = {
-    #    "ids": records.ids,
-    #    "times": records.times,
-    #    "method": records.method,
-    #    "alter_correctness": records.distances,
-    #    "distance_difference": records.distance_diffs
-    #}
-    '''distance_df = pd.DataFrame()
-    distance_df.insert(0, "id", records.ids)
-    distance_df.insert(1, "time", records.times)
-    distance_df.insert(2, "method", records.method)
-    distance_df.insert(3, "Alter correctness", records.distances)
-    distance_df.insert(4, "Distance difference", records.distance_diffs)'''
-    with open(filename, "w") as f:
-        f.write("id,time,method,Alter correctness,Distance difference\n")
-        for i in range(len(measurement_tool.distance_records.ids)):
-            f.write("%d,%d,%s,%d,%d\n"%(
-                int(measurement_tool.distance_records.ids[i]),
-                measurement_tool.distance_records.times[i],
-                measurement_tool.distance_records.method[i],
-                measurement_tool.distance_records.distances[i],
-                measurement_tool.distance_records.distance_diffs[i]))
+def create_distance_data(measurement_tool, filename, policy=0):
+    measurement_tool.distance_records[policy].save_csv(filename)
     return None
 
-def save_results(measurement_tool, path_to_save):
+def save_results(measurement_tool, path_to_save, result_format="csv", metadata=None):
+    '''
+        Saves the IONG values and the distance records of a run.
+        Parameters:
+            measurement_tool: the MeasCallback object of the run
+            path_to_save: result directory (with a trailing separator), or a list of them:
+                one per policy of measurement_tool
+            result_format: "csv" (iong.csv, distances.csv and metadata.json) or "binary" (see tools.results)
+            metadata: json serializable run metadata (e.g. config, mix_n, seed), stored in every format
+                and in the summary, or a list of them (one per policy)
+        Returns:
+            iongs and distances (a list of them per policy if path_to_save is a list)
+    '''
+    if measurement_tool.deferred_evaluation:
+        start = time.time()
+        measurement_tool.evaluate_deferred_events()
+        print("Deferred sharing events evaluated in %f seconds"%(time.time()-start))
+    measurement_tool.finish_summary()
+    paths = path_to_save if isinstance(path_to_save, list) else [path_to_save]
+    metadatas = metadata if isinstance(metadata, list) else [metadata]*len(paths)
+    assert len(paths) == len(measurement_tool.policies)
+    answer = [_save_policy_results(measurement_tool, policy, path, result_format, policy_metadata)
+              for policy, (path, policy_metadata) in enumerate(zip(paths, metadatas))]
+    return answer if isinstance(path_to_save, list) else answer[0]
+
+def _save_policy_results(measurement_tool, policy, path_to_save, result_format, metadata):
+    summary = measurement_tool.summaries[policy]
+    if not(summary is None):
+        summary.save(path_to_save+"summary.json", metadata)
     start = time.time()
-    iongs = create_iongs_dataframe(measurement_tool)
+    iongs = create_iongs_dataframe(measurement_tool, policy)
     print("IONG collected in %f seconds"%(time.time()-start))
     
     start = time.time()
-    distances = create_distance_data(measurement_tool, path_to_save+"distances.csv")
+    if result_format == "binary":
+        #without stored records, only the summary of the distances is kept:
+        n_chunks = (measurement_tool.distance_records[policy].save_binary(path_to_save)
+                    if measurement_tool.store_records else 0)
+        results.save_iong(path_to_save, iongs)
+        results.save_meta(path_to_save, metadata, n_chunks, list(iongs.columns[1:]))
+        print("Results saved in %f seconds"%(time.time()-start))
+        return iongs, None
+    #not meta.json: that marks binary runs (see tools.results.load_runs):
+    with open(path_to_save+"metadata.json", "w") as f:
+        json.dump(metadata, f)
+    if not(measurement_tool.store_records):
+        iongs.to_csv(path_to_save+"iong.csv", index=False)
+        return iongs, None
+    distances = create_distance_data(measurement_tool, path_to_save+"distances.csv", policy)
     print("Distances collected in %f seconds"%(time.time()-start))
     iongs.to_csv(path_to_save+"iong.csv", index=False)
     #with open(path_to_save+"distances.json", "w") as f:
     #    json.dump(distances, f)
     #distances.to_csv(path_to_save+"distances.csv", index=False)
-    return iongs, distances
\ No newline at end of file
+    return iongs, distances
@@ -0,0 +1,26 @@
+import os
+import sys
+
+#the modules of src/ are imported as top-level modules (as the scripts run from src/):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import pytest
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+
+
+@pytest.fixture(scope="session")
+def small_config(tmp_path_factory):
+    '''A short measurement configuration on the grid of data/ (the chain artifacts are
+    cached for the whole session).'''
+    import sumolib
+    n_edges = len(sumolib.net.readNet(os.path.join(DATA_DIR, "large_grid2_noart.net.xml")).getEdges())
+    return {"sumo_grid": os.path.join(DATA_DIR, "large_grid2_noart.net.xml"),
+            "default_turning_definition": [0.3, 0.5, 0.2],
+            "specific_turning_definition": os.path.join(DATA_DIR, "turnings2.xml"),
+            "feeding_model": {"origin_model": [1.0/n_edges]*n_edges,
+                              "path_length_model": [0.1]*10,
+                              "feed": [8.0]*10},
+            "origin_inference": "vector_propagation",
+            "artifact_cache_dir": str(tmp_path_factory.mktemp("artifacts")),
+            "seed": 5}
@@ -0,0 +1,129 @@
+'''The batched/tracked implementations must give the same results as the original (scalar) ones.'''
+
+import numpy as np
+import pytest
+
+import metrics
+import movement_tracker
+import tell_decisions
+
+N_EDGES = 30
+MAX_LEN = 16
+MIX_N = [1, 2, 3]
+
+
+class ForcedRng:
+    '''Generator stub forcing the random choices of the MIX method (both the scalar
+    and the batched implementations draw through it).'''
+    def __init__(self, method, n_index, uniform):
+        self.method = method
+        self.n_index = n_index
+        self.uniform = uniform
+
+    def integers(self, low, high, size=None):
+        if low == 0: #method of the MIX selection
+            return np.full(size, self.method)
+        #uniform length, in [1, high):
+        return np.minimum(self.uniform, np.asarray(high)-1)
+
+    def choice(self, a, size=None):
+        a = np.asarray(a)
+        if (len(a) == len(MIX_N)+2) and (a[0] == 0): #method of the scalar MIX selection
+            return np.full(size, self.method)
+        return np.full(size, a[self.n_index])
+
+
+@pytest.fixture(scope="module")
+def chain():
+    rng = np.random.default_rng(0)
+    #sparse backward chain with a unique most likely predecessor of every edge:
+    P_b = rng.random((N_EDGES, N_EDGES)) * (rng.random((N_EDGES, N_EDGES)) < 0.2)
+    P_b[np.arange(N_EDGES), rng.integers(0, N_EDGES, N_EDGES)] += 1.0
+    P_b /= P_b.sum(axis=1, keepdims=True)
+    p_length = np.full(MAX_LEN, 1.0/MAX_LEN)
+    source_probs = metrics.SourceProbabilities(None, P_b, p_length)
+    #about half of the finding probabilities are above the origin probabilities:
+    o_dist = np.full(N_EDGES, np.median(source_probs.power_tensor))
+    return P_b, source_probs, o_dist
+
+
+@pytest.fixture(scope="module")
+def routes(chain):
+    P_b, source_probs, o_dist = chain
+    rng = np.random.default_rng(1)
+    lengths = rng.integers(1, MAX_LEN, 60)
+    routes = [rng.integers(0, N_EDGES, length) for length in lengths]
+    tracker = movement_tracker.MovementTracker(tell_decisions.most_likely_predecessors(P_b), o_dist,
+                                               source_probs, max_len=4, capacity=8)
+    #every vehicle starts at t=0 and moves one edge per step:
+    for t in range(MAX_LEN):
+        ids = np.array([i for i, route in enumerate(routes) if t < len(route)])
+        tracker(t, np.array([routes[i][t] for i in ids]), ids, None)
+    return routes, tracker
+
+
+def test_tracked_routes(routes):
+    routes, tracker = routes
+    for i, route in enumerate(routes):
+        assert np.array_equal(tracker.movements[i], route)
+
+
+@pytest.mark.parametrize("n", [1, 2, 3])
+def test_tell_last_n(chain, routes, n):
+    P_b, _, _ = chain
+    routes, tracker = routes
+    ids = np.arange(len(routes))
+    expected = [len(tell_decisions.tell_last_n(P_b, route, n)) for route in routes]
+    tracked = tell_decisions.tell_last_n_from_turns(tracker.lengths(ids), tracker.nth_last_turns(ids, n))
+    assert np.array_equal(tracked, expected)
+
+
+def test_tell_min_prob(chain, routes):
+    P_b, source_probs, o_dist = chain
+    routes, tracker = routes
+    expected = [len(tell_decisions.tell_min_prob(P_b, route, o_dist, None, source_probs)) for route in routes]
+    assert np.array_equal(tracker.min_prob_lengths(np.arange(len(routes))), expected)
+    #both outcomes of the min-prob rule are covered:
+    assert 0 < np.count_nonzero(np.array(expected) < [len(route) for route in routes]) < len(routes)
+
+
+@pytest.mark.parametrize("method", range(len(MIX_N)+2))
+@pytest.mark.parametrize("n_index", range(len(MIX_N)))
+def test_tell_mix(chain, routes, method, n_index):
+    P_b, source_probs, o_dist = chain
+    routes, tracker = routes
+    rng = ForcedRng(method, n_index, uniform=3)
+    expected = [len(tell_decisions.tell_mix(P_b, route, o_dist, None, MIX_N, source_probs, rng))
+                for route in routes]
+    tracked = tell_decisions.tell_mix_tracked(tracker, np.arange(len(routes)), MIX_N, rng)
+    assert np.array_equal(tracked, expected)
+
+
+def test_tell_batch_segments(chain, routes):
+    P_b, source_probs, o_dist = chain
+    routes, tracker = routes
+    ids = np.arange(len(routes))
+    rng = ForcedRng(method=3, n_index=1, uniform=2)
+    bounds = tell_decisions.tell_batch(tracker, ids, MIX_N, rng)
+    expected = {"uniform": lambda route: tell_decisions.tell_uniform(P_b, route, rng),
+                "minprob": lambda route: tell_decisions.tell_min_prob(P_b, route, o_dist, None, source_probs),
+                "last1": lambda route: tell_decisions.tell_last_n(P_b, route, 1),
+                "last2": lambda route: tell_decisions.tell_last_n(P_b, route, 2),
+                "last3": lambda route: tell_decisions.tell_last_n(P_b, route, 3),
+                "mix": lambda route: tell_decisions.tell_mix(P_b, route, o_dist, None, MIX_N, source_probs, rng)}
+    assert set(bounds) == set(expected)
+    for method, (starts, ends) in bounds.items():
+        segments = tracker.segments(ids, starts, ends)
+        offsets = np.concatenate(([0], np.cumsum(ends-starts)))
+        for k, route in enumerate(routes):
+            assert np.array_equal(segments[offsets[k]:offsets[k+1]], expected[method](route)), method
+
+
+@pytest.mark.parametrize("n", [1, 10, 40])
+def test_origin_guess_index(n):
+    rng = np.random.default_rng(2)
+    alter_sources = rng.random((50, 35))
+    source_probs = metrics.SourceProbabilities.from_arrays(np.zeros((1,)+alter_sources.shape), alter_sources)
+    guesses = metrics.OriginGuessIndex(source_probs, n=n, block_size=16)
+    for edge in range(len(alter_sources)):
+        assert np.array_equal(guesses(edge), np.argsort(alter_sources[edge])[::-1][:n])
@@ -0,0 +1,58 @@
+'''The bitset IONG of ReceivedInformation must give the same results as metrics.compute_iong.'''
+
+import numpy as np
+import pytest
+
+import metrics
+import measurement_tool
+
+N_EDGES = 130 #not a multiple of the 64 bit words
+N_VEHICLES = 40
+
+
+def _fill(received_information, rng):
+    #visited routes and received segments (per method) of the vehicles, a few of them receive nothing:
+    routes = [rng.integers(0, N_EDGES, rng.integers(1, 30)) for _ in range(N_VEHICLES)]
+    gathered = [[[] for _ in range(N_VEHICLES)] for _ in received_information.method_names]
+    for t in range(30):
+        ids = np.array([i for i, route in enumerate(routes) if t < len(route)])
+        if len(ids) == 0:
+            continue
+        received_information.visit(ids, [routes[i][t] for i in ids])
+        receivers = rng.choice(ids, size=len(ids)//2)
+        receivers = receivers[receivers % 7 != 0]
+        for m, method in enumerate(received_information.method_names):
+            lengths = rng.integers(1, 6, len(receivers))
+            edges = rng.integers(0, N_EDGES, lengths.sum())
+            received_information.receive(method, receivers, edges, lengths)
+            offsets = np.concatenate(([0], np.cumsum(lengths)))
+            for k, receiver in enumerate(receivers):
+                gathered[m][receiver].extend(edges[offsets[k]:offsets[k+1]])
+    return routes, gathered
+
+
+def _expected(routes, gathered, ids):
+    return np.array([[metrics.compute_iong(routes[i], method_gathered[i]) if len(method_gathered[i]) > 0 else -1
+                      for i in ids] for method_gathered in gathered])
+
+
+def test_iong():
+    received_information = measurement_tool.ReceivedInformation(N_EDGES, capacity=4)
+    routes, gathered = _fill(received_information, np.random.default_rng(0))
+    ids = np.arange(N_VEHICLES)
+    expected = _expected(routes, gathered, ids)
+    assert np.array_equal(received_information.iong(ids), expected)
+    #both kinds of vehicles are covered:
+    assert 0 < np.count_nonzero(expected[0] == -1) < N_VEHICLES
+
+
+#the buffers are compacted only when at least half of the slots are released:
+@pytest.mark.parametrize("first_id", [10, 35])
+def test_iong_after_eviction(first_id):
+    received_information = measurement_tool.ReceivedInformation(N_EDGES, capacity=4)
+    routes, gathered = _fill(received_information, np.random.default_rng(1))
+    received_information.evict(first_id)
+    ids = np.arange(N_VEHICLES)
+    expected = _expected(routes, gathered, ids)
+    expected[:, :first_id] = -1
+    assert np.array_equal(received_information.iong(ids), expected)
@@ -0,0 +1,58 @@
+'''BatchSampler must sample the rows of the chain, and keep the absorbing states in place.'''
+
+import numpy as np
+import scipy.sparse as sp
+import pytest
+
+from simulation.mc_sampler import BatchSampler
+
+N_STATES = 12
+ABSORBING = [0, 5, 6, N_STATES-1] #the first and the last row are absorbing too
+
+
+class ConstantRng:
+    def __init__(self, value):
+        self.value = value
+
+    def random(self, size):
+        return np.full(size, self.value)
+
+
+@pytest.fixture(scope="module")
+def chain():
+    rng = np.random.default_rng(0)
+    P = rng.random((N_STATES, N_STATES)) * (rng.random((N_STATES, N_STATES)) < 0.4)
+    P[np.arange(N_STATES), rng.integers(0, N_STATES, N_STATES)] += 0.5
+    P /= P.sum(axis=1, keepdims=True)
+    P[ABSORBING] = 0.0
+    return P
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_absorbing_states(chain, sparse):
+    sampler = BatchSampler(sp.csr_matrix(chain) if sparse else chain, np.random.default_rng(1))
+    states = np.repeat(np.arange(N_STATES), 50)
+    next_states = sampler(states)
+    absorbing = np.isin(states, ABSORBING)
+    assert np.array_equal(next_states[absorbing], states[absorbing])
+    #the other states move along the transitions of the chain:
+    assert np.all(chain[states[~absorbing], next_states[~absorbing]] > 0)
+
+
+@pytest.mark.parametrize("value", [0.0, 0.5, 1.0-1e-12])
+def test_extreme_draws(chain, value):
+    #the draws at the ends of the rows stay in their rows:
+    next_states = BatchSampler(chain, ConstantRng(value))(np.arange(N_STATES))
+    for state, next_state in enumerate(next_states):
+        if state in ABSORBING:
+            assert next_state == state
+        else:
+            assert chain[state, next_state] > 0
+
+
+def test_distribution(chain):
+    sampler = BatchSampler(chain, np.random.default_rng(2))
+    n_samples = 20000
+    for state in [1, 7]:
+        frequencies = np.bincount(sampler(np.full(n_samples, state)), minlength=N_STATES)/n_samples
+        assert np.allclose(frequencies, chain[state], atol=0.02)
@@ -0,0 +1,72 @@
+'''End-to-end properties of the measurements on a short run.'''
+
+import os
+import copy
+
+import numpy as np
+import pandas as pd
+
+import measurement
+import tools.results
+
+
+def _results(path):
+    return {name: pd.read_csv(path+name) for name in ["distances.csv", "iong.csv"]}
+
+
+def test_policy_alone_and_in_group(small_config, tmp_path):
+    #the MIX decisions of a policy do not depend on the other policies of the run:
+    alone = str(tmp_path/"alone")+"/"
+    group = [str(tmp_path/name)+"/" for name in ["mix123", "mix13"]]
+    for path in [alone]+group:
+        os.makedirs(path)
+    measurement.run_measurement(copy.deepcopy(small_config), alone, [1, 3])
+    measurement.run_measurement(copy.deepcopy(small_config), group, [[1, 2, 3], [1, 3]])
+    expected = _results(alone)
+    for name, results in _results(group[1]).items():
+        pd.testing.assert_frame_equal(results, expected[name])
+    assert len(expected["distances.csv"]) > 0
+
+
+def test_deferred_evaluation(small_config, tmp_path):
+    #the deferred (batched) evaluation gives the same records as the inline one:
+    paths = {deferred: str(tmp_path/("deferred" if deferred else "inline"))+"/" for deferred in [False, True]}
+    for deferred, path in paths.items():
+        os.makedirs(path)
+        config = copy.deepcopy(small_config)
+        config["deferred_evaluation"] = deferred
+        measurement.run_measurement(config, path, [1, 2])
+    inline, deferred = _results(paths[False]), _results(paths[True])
+    for name, results in deferred.items():
+        pd.testing.assert_frame_equal(results, inline[name])
+
+
+def test_result_formats(small_config, tmp_path):
+    #the binary results of a run, loaded by tools.results.load_runs, are the same as its csv results:
+    paths = {result_format: str(tmp_path/result_format)+"/" for result_format in ["csv", "binary"]}
+    for result_format, path in paths.items():
+        os.makedirs(path)
+        config = copy.deepcopy(small_config)
+        config["result_format"] = result_format
+        config["distance_chunk_size"] = 1000 #several chunks
+        measurement.run_measurement(config, path, [1, 2])
+    runs = tools.results.load_runs(str(tmp_path))
+    assert list(runs) == ["binary"] #csv runs have no meta.json
+    run = runs["binary"]
+    assert run.metadata["mix_n"] == [1, 2]
+    assert run.n_chunks > 1
+    expected = _results(paths["csv"])
+    iongs = run.iong()
+    assert list(iongs) == list(expected["iong.csv"].columns)
+    for column, values in iongs.items():
+        assert np.array_equal(values, expected["iong.csv"][column].to_numpy()), column
+    distances = run.distances()
+    csv_distances = expected["distances.csv"]
+    assert sum(len(columns["ids"]) for columns in distances.values()) == len(csv_distances)
+    for method, columns in distances.items():
+        rows = csv_distances[csv_distances["method"] == method]
+        assert np.array_equal(columns["ids"], rows["id"].to_numpy()), method
+        assert np.array_equal(columns["times"], rows["time"].to_numpy()), method
+        #the csv distances are rounded to meters:
+        assert np.array_equal(np.rint(columns["distances"]), rows["Alter correctness"].to_numpy()), method
+        assert np.array_equal(np.rint(columns["distance_diffs"]), rows["Distance difference"].to_numpy()), method
@@ -0,0 +1,57 @@
+'''Meeting must give the same pairs as the original name-based (scalar) implementation.'''
+
+import numpy as np
+
+import meeting_model
+
+GRID = 5
+
+
+def _grid_edges():
+    #edges between the neighboring junctions of a GRID x GRID grid, named as in the grid networks:
+    junctions = ["%s%d"%(chr(ord("A")+x), y) for x in range(GRID) for y in range(GRID)]
+    names = []
+    for x in range(GRID):
+        for y in range(GRID):
+            for dx, dy in [(1, 0), (-1, 0), (0, 1), (0, -1)]:
+                if (0 <= x+dx < GRID) and (0 <= y+dy < GRID):
+                    names.append(junctions[x*GRID+y] + junctions[(x+dx)*GRID+y+dy])
+    edge_to_index_map = {name: i for i, name in enumerate(names)}
+    return edge_to_index_map, {i: name for name, i in edge_to_index_map.items()}
+
+
+class ScalarMeeting:
+    '''The original implementation (every vehicle is compared with every other one).'''
+    def __init__(self, edge_to_index_map):
+        neighbors = meeting_model._collect_neighborings(list(edge_to_index_map.keys()))
+        self.neighbor_indices = {edge_to_index_map[edge]: [edge_to_index_map[e] for e in neighbors[edge]]
+                                 for edge in neighbors}
+        self.last_meetings = {}
+
+    def __call__(self, t, states):
+        results = []
+        for i, s in enumerate(states):
+            if s in self.neighbor_indices:
+                for m in np.arange(0, len(states))[np.isin(states, self.neighbor_indices[s])]:
+                    if (i != m) and (self.last_meetings.get((i, m), -2) < t-1):
+                        results.append([i, m])
+                        self.last_meetings[(i, m)] = t
+        return results
+
+
+def test_meeting_from_names():
+    edge_to_index_map, index_to_edge_map = _grid_edges()
+    meeting = meeting_model.Meeting(edge_to_index_map, index_to_edge_map)
+    expected = ScalarMeeting(edge_to_index_map)
+    rng = np.random.default_rng(0)
+    n_vehicles = 60
+    states = rng.integers(0, len(edge_to_index_map), n_vehicles)
+    n_pairs = 0
+    for t in range(20):
+        #a part of the vehicles stays, so the meetings of the last step are blocked:
+        moving = rng.random(n_vehicles) < 0.3
+        states = np.where(moving, rng.integers(0, len(edge_to_index_map), n_vehicles), states)
+        pairs = meeting(t, states, np.arange(n_vehicles), np.ones(n_vehicles))
+        assert sorted(pairs) == sorted(expected(t, states))
+        n_pairs += len(pairs)
+    assert n_pairs > 0
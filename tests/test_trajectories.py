@@ -0,0 +1,61 @@
+'''Replaying recorded trajectories.'''
+
+import os
+import copy
+
+import numpy as np
+import pandas as pd
+
+import measurement
+import simulation.trajectories as trajectories
+
+N_STEPS = 40
+
+
+class StepSums:
+    '''Stateless callback collecting a summary of every step.'''
+    def __init__(self):
+        self.sums = {}
+
+    def __call__(self, t, states, ids, remainings):
+        self.sums[t] = (len(ids), int(np.sum(states)), int(np.sum(ids)), int(np.sum(remainings)))
+
+
+def _record(path):
+    rng = np.random.default_rng(0)
+    #small chunks, so the trajectory has many of them (and some empty steps):
+    recorder = trajectories.TrajectoryRecorder(path, chunk_rows=50)
+    for t in range(N_STEPS):
+        n = rng.integers(0, 30) if t % 9 else 0
+        recorder(t, rng.integers(0, 100, n), np.sort(rng.choice(1000, n, replace=False)), rng.integers(0, 20, n))
+    recorder.close()
+
+
+def test_replay_parallel(tmp_path):
+    path = str(tmp_path/"trajectory")
+    _record(path)
+    expected = StepSums()
+    assert trajectories.replay(path, expected) == N_STEPS
+    assert len(trajectories.Trajectory(path).chunk_starts) > 4
+    for n_parts in [1, 3, 100]:
+        callbacks = trajectories.replay_parallel(path, StepSums, workers=2, n_parts=n_parts)
+        sums = {}
+        for callback in callbacks:
+            sums.update(callback.sums)
+        assert sums == expected.sums
+
+
+def test_replay_recorded_run(small_config, tmp_path):
+    #replaying a recorded run (with the seed of the recording) repeats its results:
+    recorded, replayed = str(tmp_path/"recorded")+"/", str(tmp_path/"replayed")+"/"
+    for path in [recorded, replayed]:
+        os.makedirs(path)
+    config = copy.deepcopy(small_config)
+    config["record_trajectory"] = str(tmp_path/"trajectory")
+    recorded_steps = measurement.run_measurement(config, recorded, [1, 2])
+    config = copy.deepcopy(small_config)
+    del config["seed"]
+    config["replay_trajectory"] = str(tmp_path/"trajectory")
+    assert measurement.run_measurement(config, replayed, [1, 2]) == recorded_steps
+    for name in ["distances.csv", "iong.csv"]:
+        pd.testing.assert_frame_equal(pd.read_csv(replayed+name), pd.read_csv(recorded+name))